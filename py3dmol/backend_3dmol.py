@@ -1,11 +1,23 @@
+import atexit
+import functools
+import hashlib
+import importlib.util
 import json
+import logging
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import base64
 import requests
-import uuid
+import secrets
+import string
+import threading
 from io import BytesIO
+from urllib.parse import urlsplit
 from typing import Optional, Union
 import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     from cStringIO import StringIO  # Python 2.x
@@ -53,29 +65,24 @@ try:
 except ImportError:
     HAS_NUMPY = False
 
-# Initialize headless capture capabilities during import
+_logger = logging.getLogger("py3dmol")
+
+# Check headless capture capabilities during import. The webdriver itself is started
+# lazily by the first headless capture and then reused for the rest of the process.
 print("🔧 Initializing py3dmol headless capabilities...")
 _HEADLESS_AVAILABLE = False
-_HEADLESS_CAPTURE = None
 _HEADLESS_ERROR = None
+_driver_pool = None
 
 try:
     from .headless_capture import HeadlessCapture, is_headless_available, capture_headless_image
+    # Pool of drivers (PY3DMOL_DRIVER_POOL_SIZE), one capture per driver at a time
+    from .headless_capture import _driver_pool
     
-    # Try to create a headless capture instance to test availability
-    print("📊 Testing headless driver availability...")
-    _HEADLESS_CAPTURE = HeadlessCapture()
-    _HEADLESS_AVAILABLE = _HEADLESS_CAPTURE.is_available()
-    
-    if _HEADLESS_AVAILABLE:
-        print("✅ Headless capture initialized and ready!")
-        print("   - Selenium webdriver is available")
-        print("   - First image capture will be faster")
-    else:
-        print("⚠️ Headless capture initialized but no webdriver available")
-        print("   - Install Chrome/Firefox and selenium for headless support")
-        print("   - pip install selenium webdriver-manager")
-        _HEADLESS_CAPTURE = None
+    if importlib.util.find_spec("selenium") is None:
+        raise ImportError("No module named 'selenium'")
+    _HEADLESS_AVAILABLE = True
+    print("✅ Headless capture available - the webdriver starts on first capture")
         
 except ImportError as e:
     _HEADLESS_ERROR = f"Missing dependencies: {e}"
@@ -85,33 +92,391 @@ except Exception as e:
     _HEADLESS_ERROR = f"Initialization error: {e}"
     print(f"⚠️ Headless capture initialization failed: {_HEADLESS_ERROR}")
 
+# One cached loader for the bundled 3Dmol.js and one copy of the render helpers,
+# shared with the headless capture page
+from .headless_capture import _load_3dmol_js, _RENDER_HELPERS_JS
 
+# Shared HTTP session so health checks and image retrieval reuse connections
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
 
-# Try to import and initialize 3Dmol.js
-try:
-    import pkg_resources
+def _get_session() -> requests.Session:
+    """Get the shared keep-alive session used for all image server calls"""
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                session = requests.Session()
+                # Don't retry reads: a long-poll that times out should not be repeated
+                retry = Retry(total=3, read=0, backoff_factor=0.1,
+                              status_forcelist=(502, 503, 504), raise_on_status=False)
+                session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                                     max_retries=retry))
+                # JSON/base64 image payloads compress well; the server gzips them
+                session.headers["Accept-Encoding"] = "gzip"
+                _SESSION = session
+    return _SESSION
+
+# Worker threads that wait on image captures so the kernel isn't blocked
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="py3dmol-capture")
+
+# Upper bound on the JavaScript sent in a single display() call, to avoid stalling
+# the kernel -> frontend channel with very large messages
+_COMMAND_BATCH_BYTES = 64 * 1024
+
+def _chunk_commands(commands, batch_size):
+    """Group commands into consecutive chunks of roughly batch_size characters"""
+    chunk, size = [], 0
+    for command in commands:
+        if chunk and size + len(command) > batch_size:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(command)
+        size += len(command) + 1
+    if chunk:
+        yield chunk
+
+# The bundled 3Dmol.js is sent with the first viewer of the kernel session only; later
+# viewers find $3Dmol already loaded (or fall back to the CDN after a page reload).
+_3dmol_lib_sent = False
+
+# CDN copies of 3Dmol.js raced by the viewer script when $3Dmol is missing
+_3DMOL_CDN_SOURCES = (
+    'https://3Dmol.org/build/3Dmol-min.js',
+    'https://cdn.jsdelivr.net/npm/3dmol@latest/build/3Dmol-min.js',
+    'https://unpkg.com/3dmol@latest/build/3Dmol-min.js',
+)
+
+# Resource hints for viewers shown without the bundled library. The viewer script races
+# the CDNs whenever $3Dmol is missing (e.g. after a page reload), so warm up DNS/TLS
+# for them; the downloads themselves are only preloaded when there is no bundle at all.
+_CDN_PRECONNECTS = ''.join(
+    f'<link rel="preconnect" href="{urlsplit(src).scheme}://{urlsplit(src).netloc}" crossorigin>'
+    for src in _3DMOL_CDN_SOURCES
+) + '\n'
+_CDN_HINTS = _CDN_PRECONNECTS + ''.join(
+    f'<link rel="preload" as="fetch" href="{src}" crossorigin>' for src in _3DMOL_CDN_SOURCES
+) + '\n'
+
+@functools.lru_cache(maxsize=None)
+def _3dmol_script_tag() -> str:
+    """The bundled 3Dmol.js, pre-wrapped in a <script> tag (built once)"""
+    js = _load_3dmol_js()
+    if not js:
+        return ''
+    lib_id = f"py3dmol-lib-{hashlib.sha1(js.encode('utf-8')).hexdigest()[:12]}"
+    return ('<script id="' + lib_id + '">\n' +
+            js.replace('</script', '<\\/script') +
+            '\n</script>\n')
+
+def _freeze(obj):
+    """Hashable key for a JSON value; scalars are tagged with their type so 1, 1.0 and True differ"""
+    if isinstance(obj, dict):
+        return ('dict', tuple((k, _freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return ('list', tuple(_freeze(v) for v in obj))
+    return (type(obj).__name__, obj)
+
+
+def _thaw(key):
+    """Rebuild the JSON value described by a _freeze() key"""
+    tag, value = key
+    if tag == 'dict':
+        return {k: _thaw(v) for k, v in value}
+    if tag == 'list':
+        return [_thaw(v) for v in value]
+    return value
+
+
+@functools.lru_cache(maxsize=1024)
+def _jdumps_frozen(key) -> str:
+    return json.dumps(_thaw(key))
+
+
+def _jdumps(obj) -> str:
+    """json.dumps() memoized for the small selector/style/option values repeated across calls"""
     try:
-        _3dmol_js = pkg_resources.resource_string(__name__, "3Dmol-min.js").decode("utf-8")
-    except (FileNotFoundError, AttributeError):
-        # Fallback for development or if package resource is not available
-        import os
-        module_dir = os.path.dirname(__file__)
-        # Try both the minified and non-minified versions
-        for js_filename in ["3Dmol-min.js", "3dmol.js"]:
-            js_path = os.path.join(module_dir, js_filename)
-            if os.path.exists(js_path):
-                with open(js_path, 'r') as f:
-                    _3dmol_js = f.read()
-                print(f"✅ Loaded local 3DMol.js from: {js_path}")
-                break
-        else:
-            _3dmol_js = ""
-            print("⚠️  No local 3DMol.js file found")
-    _imported_3dmol = True
-except (ImportError, FileNotFoundError, AttributeError):
-    _3dmol_js = ""
-    _imported_3dmol = True
+        key = _freeze(obj)
+        hash(key)
+    except TypeError:
+        return json.dumps(obj)
+    return _jdumps_frozen(key)
+
+
+# Name of the local bound to the viewer wherever queued commands run; executeCode
+# rewrites $3Dmol.viewers['<id>'] lookups to it
+_VIEWER_SENTINEL = "__V__"
+
+# Browser-side executor for queued commands, defined by every viewer's startjs.
+# Commands arrive as a JSON list and run as soon as the viewer's readiness promise
+# (created by startjs, resolved by init3DMolViewer) resolves.
+_EXEC_WRAPPER_TEMPLATE = """
+window._py3dmol_exec = function(id, cmds) {
+    console.log('🚀 Queued ' + cmds.length + ' commands for viewer: ' + id);
+    
+    window.py3dmol_viewer_ready = window.py3dmol_viewer_ready || {};
+    window.__py3dmol_resolve = window.__py3dmol_resolve || {};
+    if (!window.py3dmol_viewer_ready[id]) {
+        window.py3dmol_viewer_ready[id] = new Promise(function(resolve) {
+            window.__py3dmol_resolve[id] = resolve;
+        });
+    }
+    
+    window.py3dmol_viewer_ready[id].then(function() {
+        try {
+            console.log('✅ Executing all commands...');
+            // Commands refer to their viewer through the __V__ parameter
+            new Function('__V__', cmds.join('\\n'))($3Dmol.viewers[id]);
+            console.log('✅ All commands executed successfully');
+        } catch (error) {
+            console.error('❌ Error executing commands:', error);
+        }
+    });
+};
+"""
+
+# Viewer HTML and initialization script, compiled once at import. Placeholders are
+# ${id}, ${width}, ${height}, ${cdn_sources}, ${render_helpers} and ${exec_helper};
+# literal dollars (e.g. $$3Dmol) are doubled.
+_VIEWER_TEMPLATE = string.Template("""
+<div id="${id}" style="height: ${height}px; width: ${width}px; position: relative; border: 1px solid #ccc; background-color: #f9f9f9;">
+    <div style="position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); color: #666;">
+        Loading 3DMol viewer...
+    </div>
+</div>
+<script>
+(function() {
+    console.log('🔧 Initializing 3DMol viewer for: ${id}');
+    
+    // Global variables for this viewer.
+    // Promise resolved with the viewer once it is created; queued commands wait on it.
+    // Always replaced so that re-showing a viewer waits for the new instance.
+    window.py3dmol_viewer_ready = window.py3dmol_viewer_ready || {};
+    window.__py3dmol_resolve = window.__py3dmol_resolve || {};
+    window.py3dmol_viewer_ready['${id}'] = new Promise(function(resolve) {
+        window.__py3dmol_resolve['${id}'] = resolve;
+    });
+    window.py3dmol_loading_status = window.py3dmol_loading_status || {};
+    
+    ${render_helpers}
+    
+    // Executor for commands sent by show() and flush(), defined here so that it exists
+    // even when the viewer was shown without commands
+    ${exec_helper}
+    
+    // Fetch a script from several sources in parallel and run the first good one
+    function loadFirstScript(sources) {
+        return new Promise(function(resolve, reject) {
+            var failures = 0;
+            sources.forEach(function(src) {
+                console.log('📥 Fetching script:', src);
+                fetch(src, { mode: 'cors' })
+                    .then(function(response) {
+                        if (!response.ok) throw new Error('HTTP ' + response.status);
+                        return response.text();
+                    })
+                    .then(function(text) { resolve({ src: src, text: text }); })
+                    .catch(function(e) {
+                        console.warn('⚠️ CDN failed:', src, e);
+                        if (++failures === sources.length) reject(new Error('All CDN sources failed'));
+                    });
+            });
+        }).then(function(result) {
+            if (typeof $$3Dmol !== 'undefined') return;  // another source won the race
+            var script = document.createElement('script');
+            script.text = result.text;
+            document.head.appendChild(script);
+            console.log('✅ Script loaded successfully:', result.src);
+        });
+    }
+    
+    // Function to check if element exists and is visible
+    function isElementReady(elementId) {
+        var element = document.getElementById(elementId);
+        if (!element) {
+            console.log('❌ Element not found:', elementId);
+            return false;
+        }
+        var rect = element.getBoundingClientRect();
+        if (rect.width === 0 || rect.height === 0) {
+            console.log('❌ Element has zero size:', elementId, rect);
+            return false;
+        }
+        console.log('✅ Element ready:', elementId, rect);
+        return true;
+    }
+    
+    // Function to initialize 3DMol viewer
+    function init3DMolViewer() {
+        console.log('🎯 Attempting to initialize 3DMol viewer...');
+        
+        // Check dependencies
+        if (typeof $$3Dmol === 'undefined') {
+            console.error('❌ 3Dmol.js not available');
+            document.getElementById('${id}').innerHTML = 
+                '<div style="color: red; text-align: center; padding: 20px;">3DMol.js not loaded</div>';
+            return false;
+        }
+        
+        // Check if element is ready (laid out with a non-zero size)
+        if (!isElementReady('${id}')) {
+            console.log('⏳ Element not ready, retrying in 100ms...');
+            setTimeout(init3DMolViewer, 100);
+            return false;
+        }
+        
+        try {
+            console.log('🔧 Creating 3DMol viewer...');
+            console.log('🔍 Available globals: $$3Dmol=', typeof $$3Dmol);
+            
+            // Debug 3DMol availability
+            if (typeof $$3Dmol === 'undefined') {
+                console.error('❌ $$3Dmol is not defined!');
+                document.getElementById('${id}').innerHTML = 
+                    '<div style="color: red; text-align: center; padding: 20px;">3DMol.js not loaded</div>';
+                return false;
+            }
+            
+            console.log('🔍 $$3Dmol methods:', Object.getOwnPropertyNames($$3Dmol));
+            
+            // Initialize viewers object (following 3Dmol.js documentation pattern)
+            $$3Dmol.viewers = $$3Dmol.viewers || {};
+            
+            // Get the element using native DOM method
+            var element = document.getElementById('${id}');
+            if (!element) {
+                console.error('❌ Could not find element: ${id}');
+                return false;
+            }
+            
+            console.log('✅ Found element:', element);
+            console.log('📊 Element dimensions:', element.offsetWidth, 'x', element.offsetHeight);
+            
+            // Clear any loading message
+            element.innerHTML = '';
+            
+            // Create the viewer with minimal configuration first
+            var config = {
+                backgroundColor: 'white'
+            };
+            
+            console.log('📊 Creating viewer with config:', config);
+            console.log('🔍 Calling $$3Dmol.createViewer...');
+            
+            var viewer = $$3Dmol.createViewer(element, config);
+            
+            console.log('📊 createViewer returned:', viewer);
+            console.log('📊 Viewer type:', typeof viewer);
+            
+            if (!viewer) {
+                console.error('❌ $$3Dmol.createViewer returned null/undefined');
+                document.getElementById('${id}').innerHTML = 
+                    '<div style="color: red; text-align: center; padding: 20px;">Failed to create 3DMol viewer</div>';
+                return false;
+            }
+            
+            // Store the viewer in the global viewers object
+            $$3Dmol.viewers['${id}'] = viewer;
+            
+            console.log('✅ 3DMol viewer created successfully:', '${id}');
+            console.log('📊 Viewer methods:', Object.getOwnPropertyNames(viewer).slice(0, 10));
+            
+            // Initialize the viewer properly
+            try {
+                viewer.render();
+                console.log('✅ Initial render completed');
+            } catch (renderError) {
+                console.warn('⚠️ Initial render failed:', renderError);
+            }
+            
+            // Release queued commands waiting for this viewer
+            window.__py3dmol_resolve['${id}'](viewer);
+            console.log('🎉 3DMol viewer initialization complete!');
+            
+            return true;
+            
+        } catch (error) {
+            console.error('❌ Error creating 3DMol viewer:', error);
+            console.error('❌ Stack trace:', error.stack);
+            console.error('❌ Error details:', error.message);
+            document.getElementById('${id}').innerHTML = 
+                '<div style="color: red; text-align: center; padding: 20px;">Error: ' + error.message + '</div>';
+            return false;
+        }
+    }
+    
+    // Function to make sure 3Dmol.js is available. The bundled copy is
+    // normally inlined by show(); the CDNs are only raced when it is missing
+    // (e.g. the notebook was reloaded without re-running the first viewer).
+    function load3DMol(callback) {
+        if (typeof $$3Dmol !== 'undefined') {
+            console.log('✅ 3Dmol.js already available');
+            callback();
+            return;
+        }
+        
+        var cdnSources = ${cdn_sources};
+        
+        console.log('📥 Bundled 3Dmol.js missing, racing CDN sources...');
+        loadFirstScript(cdnSources).then(function() {
+            if (typeof $$3Dmol !== 'undefined') {
+                console.log('✅ $$3Dmol is available, version info:', $$3Dmol.version || 'unknown');
+                callback();
+            } else {
+                throw new Error('Script loaded but $$3Dmol not available');
+            }
+        }).catch(function(e) {
+            console.error('❌ Failed to load 3Dmol.js:', e);
+            console.error('❌ Tried sources:', cdnSources);
+            document.getElementById('${id}').innerHTML = 
+                '<div style="color: red; text-align: center; padding: 20px;">Failed to load 3Dmol.js from all CDN sources</div>';
+        });
+    }
+    
+    // Main initialization sequence (runs once the DOM is ready)
+    function startInitialization() {
+        console.log('🚀 Starting 3DMol initialization sequence...');
+        
+        load3DMol(function() {
+            console.log('📄 DOM ready, initializing viewer...');
+            
+            // $$3Dmol is loaded and the DOM is ready, so a single attempt either
+            // creates the viewer or shows the real error in its element
+            init3DMolViewer();
+        });
+    }
+    
+    // Start the initialization
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', startInitialization);
+    } else {
+        startInitialization();
+    }
+    
+})();
+</script>
+""")
+
+# Cache of FastAPI server health checks: url -> (monotonic timestamp, ok)
+_HEALTH_CACHE_TTL = 30.0
+_health_cache = {}
+
+# How long the server may hold an image request open before answering 408
+_IMAGE_WAIT_MS = 10000
+
+def invalidate_health_cache():
+    """Forget cached server health results so the next check hits the server"""
+    _health_cache.clear()
+
+# Whether a display is available; Windows always has one, Unix needs $DISPLAY
+_HAS_DISPLAY = os.name == 'nt' or os.environ.get('DISPLAY') is not None
 
+def _env_cache_invalidate():
+    """Clear the cached environment probes (e.g. in tests that fake an environment)"""
+    _is_jupyter_environment.cache_clear()
+    _is_headless_environment.cache_clear()
+
+@functools.lru_cache(maxsize=1)
 def _is_jupyter_environment() -> bool:
     """Check if we're running in a Jupyter notebook environment"""
     if not HAS_IPYTHON_KERNEL:
@@ -128,15 +493,26 @@ def _is_jupyter_environment() -> bool:
     except:
         return False
 
+@functools.lru_cache(maxsize=1)
 def _is_headless_environment() -> bool:
     """Check if we're in a headless environment (no display)"""
     # Check for common headless indicators
-    if os.environ.get('DISPLAY') is None and os.name != 'nt':  # Unix without display
+    if not _HAS_DISPLAY:  # Unix without display
         return True
     if os.environ.get('TERM') == 'dumb':  # Dumb terminal
         return True
     return not _is_jupyter_environment()
 
+def _decode_image_data(image_data: str) -> bytes:
+    """Decode a base64 image string (optionally a data URL) to bytes"""
+    # Skip the data URL prefix if present, without splitting the whole string
+    start = image_data.find(',') + 1 if image_data.startswith('data:') else 0
+    return base64.b64decode(image_data[start:], validate=False)
+
+def _encode_image_data(image_bytes: bytes, format: str = 'png') -> str:
+    """Encode image bytes as a base64 data URL"""
+    return f"data:image/{format};base64,{base64.b64encode(image_bytes).decode()}"
+
 class JS3DMol(object):
     """
     JS3DMol object for Jupyter notebook integration
@@ -154,113 +530,108 @@ class JS3DMol(object):
         self.width = width
         self.height = height
         self.id = id if id else f'viewer_{int(time.time() * 1000)}'
-        self.commands = []
+        self.commands = deque()
+        self.debug = False  # fetch server diagnostics when a capture fails
+        self._shown = False
+        self._cmd_buf = StringIO()  # commands not yet sent to the displayed viewer
+        self._html_cache = None  # ((id, width, height), startjs HTML)
+        self._batch = None  # JS fragments collected inside a `with viewer:` block
+        self._batch_depth = 0
+        self._uploaded_blobs = set()  # model data already stored in window._py3d_blobs
+        self._commands_js_cache = None  # (len, last command, JS) compiled for headless capture
         
         if not HAS_IPYTHON:
             print("⚠️  Running without IPython - display capabilities limited")
 
     def _test_server_connectivity(self):
-        """Test if the FastAPI server is accessible"""
+        """Test if the FastAPI server is accessible (cached for a short TTL)"""
+        url = "http://localhost:8769/health"
+        cached = _health_cache.get(url)
+        if cached is not None and time.monotonic() - cached[0] < _HEALTH_CACHE_TTL:
+            return cached[1]
+        
         try:
-            response = requests.get("http://localhost:8769/health", timeout=2)
+            response = _get_session().get(url, timeout=2)
             if response.status_code == 200:
-                print("✅ FastAPI server is accessible")
-                return True
+                _logger.debug("✅ FastAPI server is accessible")
+                ok = True
             else:
                 print(f"❌ Server responded with status: {response.status_code}")
-                return False
+                ok = False
         except Exception as e:
             print(f"❌ Cannot connect to FastAPI server: {e}")
+            ok = False
+        
+        _health_cache[url] = (time.monotonic(), ok)
+        return ok
+
+    def __enter__(self):
+        """Collect the commands issued inside a `with viewer:` block into one payload"""
+        if self._batch is None:
+            self._batch = []
+        self._batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Queue the collected commands as a single command (and send it if shown)"""
+        self._batch_depth -= 1
+        if self._batch_depth:
             return False
+        batch, self._batch = self._batch, None
+        if batch:
+            self.executeCode('\n'.join(batch))
+            if self._shown:
+                self.flush()
+        return False
 
     def executeCode(self, code):
         """Execute JavaScript code in the viewer context"""
+        # Strip once here so the replay and headless paths can join commands directly
+        code = code.strip()
+        if not code:
+            return
+        # Viewer lookups become the __V__ local bound by the executor / capture script
+        code = code.replace(f"$3Dmol.viewers['{self.id}']", _VIEWER_SENTINEL)
+        
+        if self._batch is not None:
+            self._batch.append(code)
+            return
+        
         if not HAS_IPYTHON:
             print("⚠️  JavaScript execution not available without IPython")
             return
         
-        # Store the command for later execution
+        # Store the command for later execution. The full history is kept for re-showing
+        # and headless capture; the buffer holds what flush() still has to send.
         self.commands.append(code)
+        self._cmd_buf.write(code)
+        self._cmd_buf.write('\n')
         
         # Don't execute immediately - commands will be executed when show() is called
         # This prevents the infinite "Waiting for 3Dmol.js to load..." messages
 
-    def _execute_queued_commands(self):
+    def flush(self):
+        """Send commands queued since the last show()/flush() to the displayed viewer"""
+        body = self._cmd_buf.getvalue()
+        if self._shown and body:
+            self._display_commands([body])
+        self._cmd_buf = StringIO()
+
+    def _execute_queued_commands(self, batch_size=_COMMAND_BATCH_BYTES):
         """Execute all queued commands after the viewer is created"""
+        self._cmd_buf = StringIO()
         if not self.commands:
             return
         
-        # Create JavaScript to execute all commands at once
-        combined_js = []
-        for i, command in enumerate(self.commands):
-            combined_js.append(f"// Command {i+1}")
-            combined_js.append(command)
-        
-        # Wrap all commands in a function that waits for viewer to be ready with timeout
-        wrapped_code = f"""
-        (function() {{
-            console.log('🚀 Executing {len(self.commands)} queued commands for viewer: {self.id}');
-            
-            var maxAttempts = 50; // Maximum 10 seconds (50 * 200ms)
-            var attempts = 0;
-            
-            function executeWhenReady() {{
-                attempts++;
-                
-                // Check if we've exceeded maximum attempts
-                if (attempts > maxAttempts) {{
-                    console.error('❌ Timeout waiting for 3Dmol viewer to be ready');
-                    console.error('❌ Last state: $3Dmol=' + (typeof $3Dmol) + ', viewer=' + (window.py3dmol_viewer_ready ? window.py3dmol_viewer_ready['{self.id}'] : 'undefined'));
-                    return;
-                }}
-                
-                // Check if all dependencies are available
-                if (typeof $3Dmol === 'undefined') {{
-                    if (attempts === 1 || attempts % 10 === 0) {{
-                        console.log('⏳ Waiting for 3Dmol.js to load... (attempt ' + attempts + '/' + maxAttempts + ')');
-                    }}
-                    setTimeout(executeWhenReady, 200);
-                    return;
-                }}
-                
-                if (typeof $ === 'undefined') {{
-                    console.log('⏳ Waiting for jQuery to load...');
-                    setTimeout(executeWhenReady, 200);
-                    return;
-                }}
-                
-                if (!$3Dmol.viewers || !$3Dmol.viewers['{self.id}']) {{
-                    if (attempts === 1 || attempts % 10 === 0) {{
-                        console.log('⏳ Waiting for viewer to be created... (attempt ' + attempts + '/' + maxAttempts + ')');
-                    }}
-                    setTimeout(executeWhenReady, 200);
-                    return;
-                }}
-                
-                if (!window.py3dmol_viewer_ready || !window.py3dmol_viewer_ready['{self.id}']) {{
-                    if (attempts === 1 || attempts % 10 === 0) {{
-                        console.log('⏳ Waiting for viewer to be ready... (attempt ' + attempts + '/' + maxAttempts + ')');
-                    }}
-                    setTimeout(executeWhenReady, 200);
-                    return;
-                }}
-                
-                // All dependencies ready, execute all commands
-                try {{
-                    console.log('✅ Executing all commands...');
-                    {'; '.join(combined_js)}
-                    console.log('✅ All commands executed successfully');
-                }} catch (error) {{
-                    console.error('❌ Error executing commands:', error);
-                }}
-            }}
-            
-            // Start execution with a delay to allow viewer initialization
-            setTimeout(executeWhenReady, 1000);
-        }})();
-        """
-        
-        ipyd.display(Javascript(wrapped_code))
+        # The executor helper comes with the viewer HTML (startjs), so only the
+        # commands are sent here and by flush()
+        for chunk in _chunk_commands(self.commands, batch_size):
+            self._display_commands(chunk)
+
+    def _display_commands(self, commands):
+        """Send one batch of commands to the browser in a single Javascript payload"""
+        ipyd.display(Javascript(
+            f"window._py3dmol_exec({json.dumps(self.id)}, {json.dumps(commands)});"))
 
     def get_image_data(self, format='png', width=None, height=None, antialias=True, force_headless=False):
         """
@@ -276,35 +647,87 @@ class JS3DMol(object):
         Returns:
             Base64 encoded image data string or None if failed
         """
-        print(f"🔧 get_image_data() - Auto-detecting environment...")
+        return self.get_image_data_async(format, width, height, antialias, force_headless).result()
+
+    def get_image_data_async(self, format='png', width=None, height=None, antialias=True, force_headless=False):
+        """
+        Start capturing image data from the viewer without blocking
         
-        # Check if headless mode is forced
-        if force_headless:
-            print("🖥️  Forced headless mode - using headless capture method")
-            return self._get_image_data_headless(format, width, height, antialias)
+        The capture JavaScript is emitted immediately; waiting for the image runs on a
+        worker thread, so captures of several viewers overlap:
+        
+            futures = [v.get_image_data_async() for v in viewers]
+            images = [f.result() for f in futures]
         
-        # Auto-detect environment and use appropriate method
-        if _is_jupyter_environment():
-            print("🌐 Jupyter environment detected - using FastAPI server method")
-            result = self._get_image_data_fastapi(format, width, height, antialias)
+        Args:
+            format: Image format ('png' or 'jpeg')
+            width: Image width (defaults to viewer width)
+            height: Image height (defaults to viewer height)
+            antialias: Enable antialiasing
+            force_headless: Force headless capture even in Jupyter (bypasses JavaScript issues)
             
-            # If FastAPI method fails, fallback to headless
-            if result is None:
+        Returns:
+            concurrent.futures.Future resolving to the base64 image data string or None
+        """
+        return self._capture_async(format, width, height, antialias, force_headless, raw=False)
+
+    def _capture_async(self, format, width, height, antialias, force_headless, raw):
+        """Start a capture; the Future resolves to image bytes if raw, else a data URL string"""
+        _logger.debug("🔧 get_image_data() - Auto-detecting environment...")
+        
+        request_id = None
+        if force_headless:
+            # Check if headless mode is forced
+            _logger.debug("🖥️  Forced headless mode - using headless capture method")
+        elif _is_jupyter_environment():
+            # Auto-detect environment and use appropriate method
+            _logger.debug("🌐 Jupyter environment detected - using FastAPI server method")
+            # Display the capture JavaScript from the calling thread so it reaches this cell
+            request_id = self._submit(format, width, height, antialias)
+            if request_id is None:
                 print("⚠️  FastAPI method failed, falling back to headless capture...")
-                return self._get_image_data_headless(format, width, height, antialias)
-            return result
         else:
-            print("🖥️  Headless environment detected - using headless capture method")
-            return self._get_image_data_headless(format, width, height, antialias)
+            _logger.debug("🖥️  Headless environment detected - using headless capture method")
+        
+        return _EXECUTOR.submit(self._capture_job, request_id, format, width, height, antialias, raw)
+
+    def _capture_job(self, request_id, format, width, height, antialias, raw):
+        """Collect a FastAPI capture (or run a headless one) on a worker thread"""
+        image = None
+        if request_id is not None:
+            image = self._collect(request_id)
+            # If FastAPI method fails, fallback to headless
+            if image is None:
+                print("⚠️  FastAPI method failed, falling back to headless capture...")
+        if image is None:
+            image = self._get_image_data_headless(format, width, height, antialias)
+        if image is None:
+            return None
+        
+        if raw:
+            return _decode_image_data(image) if isinstance(image, str) else image
+        return _encode_image_data(image, format) if isinstance(image, bytes) else image
 
     def _get_image_data_fastapi(self, format='png', width=None, height=None, antialias=True):
         """Get image data using FastAPI server method (for Jupyter environments)"""
+        request_id = self._submit(format, width, height, antialias)
+        if request_id is None:
+            return None
+        image = self._collect(request_id)
+        return _encode_image_data(image, format) if isinstance(image, bytes) else image
+
+    def _submit(self, format='png', width=None, height=None, antialias=True):
+        """Emit the JavaScript that sends the viewer image to the FastAPI server
+        
+        Returns:
+            The request ID to collect the image with, or None if the server is unavailable
+        """
         # Check if server is available
         if not self._test_server_connectivity():
             return None
             
         # Generate unique request ID
-        request_id = str(uuid.uuid4())[:8]
+        request_id = secrets.token_hex(4)
         
         # Use default dimensions if not specified
         if width is None:
@@ -390,29 +813,26 @@ class JS3DMol(object):
                                     return;
                                 }}
                                 
-                                // Convert to base64
-                                var imageData = canvas.toDataURL('image/{format}');
-                                console.log('✅ Image data captured, length:', imageData.length);
-                                
-                                if (imageData.length < 100) {{
-                                    console.error('❌ Image data too short, likely empty canvas');
-                                    return;
-                                }}
-                                
-                                // Send to FastAPI server
-                                console.log('📤 Sending to FastAPI server...');
-                                fetch('http://localhost:8769/convert_image', {{
-                                    method: 'POST',
-                                    headers: {{
-                                        'Content-Type': 'application/json',
-                                    }},
-                                    body: JSON.stringify({{
-                                        request_id: '{request_id}',
-                                        image_data: imageData,
-                                        format: '{format}',
-                                        width: {width},
-                                        height: {height}
-                                    }})
+                                // Encode straight to a binary blob, no base64 round-trip
+                                new Promise(function(resolve) {{
+                                    canvas.toBlob(resolve, 'image/{format}');
+                                }})
+                                .then(blob => {{
+                                    if (!blob || blob.size < 100) {{
+                                        throw new Error('Image data too short, likely empty canvas');
+                                    }}
+                                    console.log('✅ Image data captured, size:', blob.size);
+                                    
+                                    // Send raw image bytes to FastAPI server
+                                    console.log('📤 Sending to FastAPI server...');
+                                    return fetch('http://localhost:8769/convert_image', {{
+                                        method: 'POST',
+                                        headers: {{
+                                            'Content-Type': blob.type,
+                                            'X-Request-Id': '{request_id}'
+                                        }},
+                                        body: blob
+                                    }});
                                 }})
                                 .then(response => {{
                                     console.log('📨 Server response status:', response.status);
@@ -463,35 +883,75 @@ class JS3DMol(object):
         
         # Execute JavaScript
         display(Javascript(js_code))
+        return request_id
+
+    def _collect(self, request_id):
+        """Wait for the image posted by the browser for request_id
         
-        # Wait for the image to be processed
-        print(f"⏳ Waiting for image capture (request ID: {request_id}...)")
-        time.sleep(5)  # Increased wait time for proper rendering
-        
-        # Check JavaScript status
-        status_check_js = """
-        if (window.py3dmol_last_capture) {
-            console.log('🔍 Last capture status:', window.py3dmol_last_capture);
-        } else {
-            console.log('❌ No capture status found');
-        }
+        Returns:
+            Raw image bytes (or a data URL string from an older server), or None if failed
         """
-        display(Javascript(status_check_js))
+        # Long-poll the server: it answers as soon as the browser has posted the image
+        _logger.debug(f"⏳ Waiting for image capture (request ID: {request_id}...)")
+        try:
+            response = _get_session().get(f'http://localhost:8769/get_image/{request_id}',
+                                          params={'format': 'raw', 'wait_ms': _IMAGE_WAIT_MS},
+                                          # Already-compressed image bytes gain nothing from gzip
+                                          headers={'Accept-Encoding': 'identity'},
+                                          timeout=_IMAGE_WAIT_MS / 1000 + 1)
+            if response.status_code == 200:
+                if response.headers.get('Content-Type', '').startswith('image/'):
+                    _logger.debug("✅ Image data retrieved successfully")
+                    return response.content
+                data = response.json()
+                if data.get('status') == 'success':
+                    _logger.debug("✅ Image data retrieved successfully")
+                    return data['image_data']
+                print(f"❌ Server error: {data.get('message', 'Unknown error')}")
+            elif response.status_code in (404, 408, 504):
+                # Timed out, or an older server without long-poll support
+                image_data = self._poll_image(request_id)
+                if image_data:
+                    return image_data
+            else:
+                print(f"❌ Server error: {response.status_code}")
+                
+        except requests.RequestException as e:
+            print(f"❌ Request error: {e}")
+        
+        # Debug: Check what's on the server
+        if self.debug:
+            try:
+                debug_response = _get_session().get('http://localhost:8769/health', timeout=5)
+                if debug_response.status_code == 200:
+                    server_data = debug_response.json()
+                    print(f"🔍 Checking server for request ID: {request_id}...")
+                    print(f"📊 Server has {len(server_data.get('pending_requests', []))} pending requests")
+                    if len(server_data.get('pending_requests', [])) == 0:
+                        print("❌ Request NOT found in server")
+                    else:
+                        print(f"🔧 Available request IDs: {server_data.get('pending_requests', [])[:3]}...")
+            except:
+                pass
         
-        # Retrieve the image from the server
-        max_attempts = 5
+        print("✗ Failed to retrieve image from server")
+        print("💡 Check browser console (F12) for detailed JavaScript errors")
+        return None
+
+    def _poll_image(self, request_id, max_attempts=5):
+        """Fallback retrieval: poll the server for a stored image"""
         for attempt in range(max_attempts):
             try:
-                response = requests.get(f'http://localhost:8769/get_image/{request_id}', timeout=5)
+                response = _get_session().get(f'http://localhost:8769/get_image/{request_id}', timeout=5)
                 if response.status_code == 200:
                     data = response.json()
                     if data.get('status') == 'success':
-                        print(f"✅ Image data retrieved successfully")
+                        _logger.debug("✅ Image data retrieved successfully")
                         return data['image_data']
                     else:
                         print(f"❌ Server error: {data.get('message', 'Unknown error')}")
                 elif response.status_code == 404:
-                    print(f"🔍 Request not found, attempt {attempt + 1}/{max_attempts}")
+                    _logger.debug(f"🔍 Request not found, attempt {attempt + 1}/{max_attempts}")
                     time.sleep(1)
                 else:
                     print(f"❌ Server error: {response.status_code}")
@@ -499,31 +959,19 @@ class JS3DMol(object):
             except requests.RequestException as e:
                 print(f"❌ Request error: {e}")
                 break
-        
-        # Debug: Check what's on the server
-        try:
-            debug_response = requests.get('http://localhost:8769/health', timeout=5)
-            if debug_response.status_code == 200:
-                server_data = debug_response.json()
-                print(f"🔍 Checking server for request ID: {request_id}...")
-                print(f"📊 Server has {len(server_data.get('pending_requests', []))} pending requests")
-                if len(server_data.get('pending_requests', [])) == 0:
-                    print("❌ Request NOT found in server")
-                else:
-                    print(f"🔧 Available request IDs: {server_data.get('pending_requests', [])[:3]}...")
-        except:
-            pass
-        
-        print("✗ Failed to retrieve image from server")
-        print("💡 Check browser console (F12) for detailed JavaScript errors")
         return None
 
     def _get_image_data_headless(self, format='png', width=None, height=None, antialias=True):
         """Get image data using headless capture method (for terminal/headless environments)"""
-        global _HEADLESS_AVAILABLE, _HEADLESS_CAPTURE, _HEADLESS_ERROR
+        global _HEADLESS_AVAILABLE, _HEADLESS_ERROR
         
-        # Check if headless capture was initialized during import
-        if not _HEADLESS_AVAILABLE:
+        # Use default dimensions if not specified
+        if width is None:
+            width = self.width
+        if height is None:
+            height = self.height
+        
+        if not _HEADLESS_AVAILABLE or _driver_pool is None:
             if _HEADLESS_ERROR:
                 print(f"❌ Headless capture not available: {_HEADLESS_ERROR}")
             else:
@@ -531,24 +979,21 @@ class JS3DMol(object):
                 print("💡 Install selenium: pip install selenium webdriver-manager")
             return None
         
-        if not _HEADLESS_CAPTURE:
-            print("❌ Headless capture instance not available")
-            return None
-            
-        # Use default dimensions if not specified
-        if width is None:
-            width = self.width
-        if height is None:
-            height = self.height
-            
-        print(f"🔧 Using pre-initialized headless capture: {width}x{height}, format: {format}")
-        
-        # Use the pre-initialized headless capture instance
+        # Concurrent captures each check out their own pooled driver (started on first
+        # use) and only wait when all PY3DMOL_DRIVER_POOL_SIZE drivers are busy
         try:
-            image_data = _HEADLESS_CAPTURE.capture_viewer_image(self, width, height, format)
+            with _driver_pool.acquire() as capture:
+                if capture is None:
+                    _HEADLESS_AVAILABLE = False
+                    _HEADLESS_ERROR = "No webdriver available (install Chrome/Firefox)"
+                    print(f"❌ Headless capture not available: {_HEADLESS_ERROR}")
+                    return None
+                
+                _logger.debug(f"🔧 Using pooled headless capture: {width}x{height}, format: {format}")
+                image_data = capture.capture_viewer_image(self, width, height, format)
             
             if image_data:
-                print("✅ Headless capture successful")
+                _logger.debug("✅ Headless capture successful")
                 return image_data
             else:
                 print("❌ Headless capture failed")
@@ -576,23 +1021,18 @@ class JS3DMol(object):
             print("❌ PIL not available. Install with: pip install pillow")
             return None
             
-        # Get image data
-        image_data = self.get_image_data(img_format, width, height, antialias, force_headless)
+        # Get raw image bytes, skipping the base64 data URL used by get_image_data()
+        image_bytes = self._capture_async(img_format, width, height, antialias, force_headless,
+                                          raw=True).result()
         
-        if not image_data:
+        if not image_bytes:
             return None
             
         try:
-            # Remove data URL prefix if present
-            if image_data.startswith('data:'):
-                image_data = image_data.split(',')[1]
-            
-            # Decode base64 to bytes
-            image_bytes = base64.b64decode(image_data)
-            
-            # Create PIL Image
+            # Create PIL Image, decoding eagerly so the byte buffer can be released
             image = Image.open(BytesIO(image_bytes))
-            print(f"✅ PIL Image created: {image.size} {image.mode}")
+            image.load()
+            _logger.debug(f"✅ PIL Image created: {image.size} {image.mode}")
             return image
             
         except Exception as e:
@@ -624,17 +1064,14 @@ class JS3DMol(object):
             return None
         
         try:
-            # Convert PIL to NumPy array
-            if pil_image.mode == 'RGBA':
-                numpy_array = np.array(pil_image)
-            elif pil_image.mode == 'RGB':
-                numpy_array = np.array(pil_image)
-            else:
-                # Convert to RGB first
+            # Convert PIL to NumPy array, converting to RGB only for other modes
+            if pil_image.mode not in ('RGB', 'RGBA'):
                 pil_image = pil_image.convert('RGB')
-                numpy_array = np.array(pil_image)
+            # np.array, not np.asarray: PIL exports through tobytes() either way, and
+            # asarray's result is read-only while callers expect to own the array
+            numpy_array = np.array(pil_image)
             
-            print(f"✅ NumPy array created: {numpy_array.shape} {numpy_array.dtype}")
+            _logger.debug(f"✅ NumPy array created: {numpy_array.shape} {numpy_array.dtype}")
             return numpy_array
             
         except Exception as e:
@@ -643,29 +1080,17 @@ class JS3DMol(object):
 
     def test_server_connection(self):
         """Test if the FastAPI server is accessible"""
+        invalidate_health_cache()
         return self._test_server_connectivity()
     
     def get_headless_status(self):
         """Get headless capture status for this viewer"""
-        global _HEADLESS_AVAILABLE, _HEADLESS_CAPTURE, _HEADLESS_ERROR
-        return {
-            'available': _HEADLESS_AVAILABLE,
-            'initialized': _HEADLESS_CAPTURE is not None,
-            'error': _HEADLESS_ERROR,
-            'driver_type': getattr(_HEADLESS_CAPTURE, 'driver', {}).get('name', 'unknown') if _HEADLESS_CAPTURE else None
-        }
+        return get_headless_status()
     
     @staticmethod
     def cleanup_headless():
         """Cleanup headless resources"""
-        global _HEADLESS_CAPTURE
-        if _HEADLESS_CAPTURE:
-            try:
-                _HEADLESS_CAPTURE.close()
-                print("✅ Headless driver cleaned up")
-            except:
-                pass
-            _HEADLESS_CAPTURE = None
+        cleanup_headless()
 
     def show(self):
         """Show the viewer"""
@@ -673,9 +1098,19 @@ class JS3DMol(object):
             print("⚠️  Display not available without IPython")
             return
             
+        global _3dmol_lib_sent
+        
         print(f"🖥️  Displaying 3DMol viewer (ID: {self.id})...")
         html = self.startjs()
+        if not _3dmol_script_tag():
+            html = _CDN_HINTS + html
+        elif not _3dmol_lib_sent:
+            html = _3dmol_script_tag() + html
+            _3dmol_lib_sent = True
+        else:
+            html = _CDN_PRECONNECTS + html
         ipyd.display(ipyd.HTML(html))
+        self._shown = True
         
         # Execute all queued commands after viewer is created
         if self.commands:
@@ -685,301 +1120,18 @@ class JS3DMol(object):
         print("✅ Viewer displayed and commands executed")
 
     def startjs(self):
-        """Get the starting JavaScript HTML"""
-        html = f"""
-        <div id="{self.id}" style="height: {self.height}px; width: {self.width}px; position: relative; border: 1px solid #ccc; background-color: #f9f9f9;">
-            <div style="position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); color: #666;">
-                Loading 3DMol viewer...
-            </div>
-        </div>
-        <script>
-        (function() {{
-            console.log('🔧 Initializing 3DMol viewer for: {self.id}');
-            
-            // Global variables for this viewer
-            window.py3dmol_viewer_ready = window.py3dmol_viewer_ready || {{}};
-            window.py3dmol_loading_status = window.py3dmol_loading_status || {{}};
-            
-            // Function to load scripts with better error handling
-            function loadScript(src, callback, errorCallback) {{
-                console.log('📥 Loading script:', src);
-                var script = document.createElement('script');
-                script.src = src;
-                script.async = true;
-                script.crossOrigin = 'anonymous';
-                
-                var timeoutId = setTimeout(function() {{
-                    console.error('❌ Script loading timeout:', src);
-                    if (errorCallback) errorCallback();
-                }}, 10000); // 10 second timeout
-                
-                script.onload = function() {{
-                    clearTimeout(timeoutId);
-                    console.log('✅ Script loaded successfully:', src);
-                    if (callback) callback();
-                }};
-                
-                script.onerror = function(e) {{
-                    clearTimeout(timeoutId);
-                    console.error('❌ Failed to load script:', src, e);
-                    if (errorCallback) errorCallback();
-                }};
-                
-                document.head.appendChild(script);
-            }}
-            
-            // Function to check if element exists and is visible
-            function isElementReady(elementId) {{
-                var element = document.getElementById(elementId);
-                if (!element) {{
-                    console.log('❌ Element not found:', elementId);
-                    return false;
-                }}
-                var rect = element.getBoundingClientRect();
-                if (rect.width === 0 || rect.height === 0) {{
-                    console.log('❌ Element has zero size:', elementId, rect);
-                    return false;
-                }}
-                console.log('✅ Element ready:', elementId, rect);
-                return true;
-            }}
-            
-            // Function to initialize 3DMol viewer
-            function init3DMolViewer() {{
-                console.log('🎯 Attempting to initialize 3DMol viewer...');
-                
-                // Check dependencies
-                if (typeof $ === 'undefined') {{
-                    console.error('❌ jQuery not available');
-                    return false;
-                }}
-                if (typeof $3Dmol === 'undefined') {{
-                    console.error('❌ 3Dmol.js not available');
-                    return false;
-                }}
-                
-                // Check if element is ready
-                if (!isElementReady('{self.id}')) {{
-                    console.log('⏳ Element not ready, retrying in 100ms...');
-                    setTimeout(init3DMolViewer, 100);
-                    return false;
-                }}
-                
-                try {{
-                    console.log('🔧 Creating 3DMol viewer...');
-                    console.log('🔍 Available globals: $3Dmol=', typeof $3Dmol, ', $=', typeof $);
-                    
-                    // Debug 3DMol availability
-                    if (typeof $3Dmol === 'undefined') {{
-                        console.error('❌ $3Dmol is not defined!');
-                        document.getElementById('{self.id}').innerHTML = 
-                            '<div style="color: red; text-align: center; padding: 20px;">3DMol.js not loaded</div>';
-                        return false;
-                    }}
-                    
-                    console.log('🔍 $3Dmol methods:', Object.getOwnPropertyNames($3Dmol));
-                    
-                    // Initialize viewers object (following 3Dmol.js documentation pattern)
-                    $3Dmol.viewers = $3Dmol.viewers || {{}};
-                    
-                    // Get the element using native DOM method first, then jQuery
-                    var element = document.getElementById('{self.id}');
-                    if (!element) {{
-                        console.error('❌ Could not find element: {self.id}');
-                        return false;
-                    }}
-                    
-                    console.log('✅ Found element:', element);
-                    console.log('📊 Element dimensions:', element.offsetWidth, 'x', element.offsetHeight);
-                    
-                    // Clear any loading message
-                    element.innerHTML = '';
-                    
-                    // Create the viewer with minimal configuration first
-                    var config = {{
-                        backgroundColor: 'white'
-                    }};
-                    
-                    console.log('📊 Creating viewer with config:', config);
-                    console.log('🔍 Calling $3Dmol.createViewer...');
-                    
-                    var viewer = $3Dmol.createViewer(element, config);
-                    
-                    console.log('📊 createViewer returned:', viewer);
-                    console.log('📊 Viewer type:', typeof viewer);
-                    
-                    if (!viewer) {{
-                        console.error('❌ $3Dmol.createViewer returned null/undefined');
-                        document.getElementById('{self.id}').innerHTML = 
-                            '<div style="color: red; text-align: center; padding: 20px;">Failed to create 3DMol viewer</div>';
-                        return false;
-                    }}
-                    
-                    // Store the viewer in the global viewers object
-                    $3Dmol.viewers['{self.id}'] = viewer;
-                    
-                    // Set viewer ready flag
-                    window.py3dmol_viewer_ready['{self.id}'] = true;
-                    
-                    console.log('✅ 3DMol viewer created successfully:', '{self.id}');
-                    console.log('📊 Viewer methods:', Object.getOwnPropertyNames(viewer).slice(0, 10));
-                    
-                    // Initialize the viewer properly
-                    try {{
-                        viewer.render();
-                        console.log('✅ Initial render completed');
-                    }} catch (renderError) {{
-                        console.warn('⚠️ Initial render failed:', renderError);
-                    }}
-                    
-                    // Trigger any waiting command execution
-                    if (window.py3dmol_execute_commands && window.py3dmol_execute_commands['{self.id}']) {{
-                        console.log('🚀 Triggering queued command execution...');
-                        window.py3dmol_execute_commands['{self.id}']();
-                    }}
-                    
-                    return true;
-                    
-                }} catch (error) {{
-                    console.error('❌ Error creating 3DMol viewer:', error);
-                    console.error('❌ Stack trace:', error.stack);
-                    console.error('❌ Error details:', error.message);
-                    document.getElementById('{self.id}').innerHTML = 
-                        '<div style="color: red; text-align: center; padding: 20px;">Error: ' + error.message + '</div>';
-                    return false;
-                }}
-            }}
-            
-            // Function to load jQuery
-            function loadJQuery(callback) {{
-                if (typeof $ !== 'undefined') {{
-                    console.log('✅ jQuery already available');
-                    callback();
-                    return;
-                }}
-                
-                console.log('📥 Loading jQuery from CDN...');
-                loadScript('https://code.jquery.com/jquery-3.6.0.min.js', 
-                    function() {{
-                        console.log('✅ jQuery loaded successfully');
-                        // Verify jQuery is properly initialized
-                        if (typeof $ !== 'undefined' && $.fn && $.fn.jquery) {{
-                            console.log('✅ jQuery version:', $.fn.jquery);
-                            setTimeout(callback, 100);
-                        }} else {{
-                            console.error('❌ jQuery loaded but not properly initialized');
-                            document.getElementById('{self.id}').innerHTML = 
-                                '<div style="color: red; text-align: center; padding: 20px;">jQuery initialization failed</div>';
-                        }}
-                    }},
-                    function() {{
-                        console.error('❌ Failed to load jQuery from CDN');
-                        document.getElementById('{self.id}').innerHTML = 
-                            '<div style="color: red; text-align: center; padding: 20px;">Failed to load jQuery</div>';
-                    }}
-                );
-            }}
-            
-            // Function to load 3Dmol.js
-            function load3DMol(callback) {{
-                if (typeof $3Dmol !== 'undefined') {{
-                    console.log('✅ 3Dmol.js already available');
-                    callback();
-                    return;
-                }}
-                
-                // Try multiple CDN sources for better reliability
-                var cdnSources = [
-                    'https://3Dmol.org/build/3Dmol-min.js',
-                    'https://cdn.jsdelivr.net/npm/3dmol@latest/build/3Dmol-min.js',
-                    'https://unpkg.com/3dmol@latest/build/3Dmol-min.js'
-                ];
-                
-                var currentCdnIndex = 0;
-                
-                function tryNextCDN() {{
-                    if (currentCdnIndex >= cdnSources.length) {{
-                        console.error('❌ All CDN sources failed');
-                        console.error('❌ Tried sources:', cdnSources);
-                        document.getElementById('{self.id}').innerHTML = 
-                            '<div style="color: red; text-align: center; padding: 20px;">Failed to load 3Dmol.js from all CDN sources</div>';
-                        return;
-                    }}
-                    
-                    var cdnUrl = cdnSources[currentCdnIndex];
-                    console.log('📥 Loading 3Dmol.js from CDN (' + (currentCdnIndex + 1) + '/' + cdnSources.length + '):', cdnUrl);
-                    
-                    loadScript(cdnUrl,
-                        function() {{
-                            console.log('✅ 3Dmol.js loaded successfully from:', cdnUrl);
-                            // Check if 3DMol is actually available
-                            if (typeof $3Dmol !== 'undefined') {{
-                                console.log('✅ $3Dmol is available, version info:', $3Dmol.version || 'unknown');
-                                setTimeout(callback, 300);
-                            }} else {{
-                                console.error('❌ Script loaded but $3Dmol not available');
-                                currentCdnIndex++;
-                                setTimeout(tryNextCDN, 100);
-                            }}
-                        }},
-                        function() {{
-                            console.warn('⚠️ CDN failed:', cdnUrl);
-                            currentCdnIndex++;
-                            setTimeout(tryNextCDN, 100);
-                        }}
-                    );
-                }}
-                
-                tryNextCDN();
-            }}
-            
-            // Main initialization sequence
-            function startInitialization() {{
-                console.log('🚀 Starting 3DMol initialization sequence...');
-                
-                loadJQuery(function() {{
-                    load3DMol(function() {{
-                        // Wait for DOM to be fully ready
-                        $(document).ready(function() {{
-                            console.log('📄 DOM ready, initializing viewer...');
-                            
-                            // Try to initialize the viewer with retries
-                            var maxRetries = 10;
-                            var retryCount = 0;
-                            
-                            function tryInit() {{
-                                if (init3DMolViewer()) {{
-                                    console.log('🎉 3DMol viewer initialization complete!');
-                                }} else {{
-                                    retryCount++;
-                                    if (retryCount < maxRetries) {{
-                                        console.log(`⏳ Retry ${{retryCount}}/${{maxRetries}} in 200ms...`);
-                                        setTimeout(tryInit, 200);
-                                    }} else {{
-                                        console.error('❌ Failed to initialize viewer after', maxRetries, 'attempts');
-                                        document.getElementById('{self.id}').innerHTML = 
-                                            '<div style="color: red; text-align: center; padding: 20px;">Failed to initialize 3DMol viewer</div>';
-                                    }}
-                                }}
-                            }}
-                            
-                            tryInit();
-                        }});
-                    }});
-                }});
-            }}
-            
-            // Start the initialization
-            if (document.readyState === 'loading') {{
-                document.addEventListener('DOMContentLoaded', startInitialization);
-            }} else {{
-                startInitialization();
-            }}
-            
-        }})();
-        </script>
-        """
-        return html
+        """Get the starting JavaScript HTML (cached until id, width or height change)"""
+        key = (self.id, self.width, self.height)
+        if self._html_cache is None or self._html_cache[0] != key:
+            self._html_cache = (key, self._build_startjs())
+        return self._html_cache[1]
+
+    def _build_startjs(self):
+        """Build the viewer HTML and initialization script"""
+        return _VIEWER_TEMPLATE.substitute(id=self.id, width=self.width, height=self.height,
+                                           cdn_sources=json.dumps(list(_3DMOL_CDN_SOURCES)),
+                                           render_helpers=_RENDER_HELPERS_JS,
+                                           exec_helper=_EXEC_WRAPPER_TEMPLATE.strip())
 
     # Add common molecular viewer methods
     def addModel(self, data, format, options=None):
@@ -987,17 +1139,30 @@ class JS3DMol(object):
         if options is None:
             options = {}
         
-        # Use JSON encoding for the molecular data to avoid JavaScript syntax issues
+        # Upload the molecular data once per viewer into a JS side-table, so that
+        # re-adding the same structure doesn't re-serialize and re-send it
+        blob = self._upload_blob(data)
+        # No `var` declarations: identical commands can then be shared by headless capture
         js_code = f"""
-        var viewer = $3Dmol.viewers['{self.id}'];
-        var moldata = {json.dumps(data)};
-        var options = {json.dumps(options)};
-        var model = viewer.addModel(moldata, "{format}", options);
-        viewer.zoomTo();
-        viewer.render();
+        $3Dmol.viewers['{self.id}'].addModel(window._py3d_blobs['{blob}'], "{format}", {_jdumps(options)});
+        $3Dmol.viewers['{self.id}'].zoomTo();
+        window.py3dmol_schedule_render('{self.id}');
         """
         self.executeCode(js_code)
 
+    def _upload_blob(self, data):
+        """Queue `data` into window._py3d_blobs (once per viewer) and return its key"""
+        raw = data if isinstance(data, str) else _jdumps(data)
+        key = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+        if key not in self._uploaded_blobs:
+            # Use JSON encoding for the molecular data to avoid JavaScript syntax issues
+            self.executeCode(
+                f"window._py3d_blobs = window._py3d_blobs || {{}};\n"
+                f"window._py3d_blobs['{key}'] = {json.dumps(data)};"
+            )
+            self._uploaded_blobs.add(key)
+        return key
+
     def setStyle(self, sel=None, style=None):
         """Set the style for molecular visualization"""
         if sel is None:
@@ -1006,9 +1171,8 @@ class JS3DMol(object):
             style = {}
             
         js_code = f"""
-        var viewer = $3Dmol.viewers['{self.id}'];
-        viewer.setStyle({json.dumps(sel)}, {json.dumps(style)});
-        viewer.render();
+        $3Dmol.viewers['{self.id}'].setStyle({_jdumps(sel)}, {_jdumps(style)});
+        window.py3dmol_schedule_render('{self.id}');
         """
         self.executeCode(js_code)
 
@@ -1018,53 +1182,62 @@ class JS3DMol(object):
             sel = {}
             
         js_code = f"""
-        var viewer = $3Dmol.viewers['{self.id}'];
-        viewer.zoomTo({json.dumps(sel)});
-        viewer.render();
+        $3Dmol.viewers['{self.id}'].zoomTo({_jdumps(sel)});
+        window.py3dmol_schedule_render('{self.id}');
         """
         self.executeCode(js_code)
 
     def render(self):
-        """Render the viewer"""
-        js_code = f"$3Dmol.viewers['{self.id}'].render();"
+        """Render the viewer now, flushing any render scheduled by earlier calls"""
+        js_code = f"window.py3dmol_flush_render('{self.id}');"
         self.executeCode(js_code)
 
     def rotate(self, angle, axis='y'):
         """Rotate the molecular view"""
         js_code = f"""
-        var viewer = $3Dmol.viewers['{self.id}'];
-        viewer.rotate({angle}, '{axis}');
-        viewer.render();
+        $3Dmol.viewers['{self.id}'].rotate({angle}, '{axis}');
+        window.py3dmol_schedule_render('{self.id}');
         """
         self.executeCode(js_code)
 
     def setBackgroundColor(self, color):
         """Set the background color"""
         js_code = f"""
-        var viewer = $3Dmol.viewers['{self.id}'];
-        viewer.setBackgroundColor('{color}');
-        viewer.render();
+        $3Dmol.viewers['{self.id}'].setBackgroundColor('{color}');
+        window.py3dmol_schedule_render('{self.id}');
         """
         self.executeCode(js_code)
 
     def start_rotation(self, axis='y', speed=1):
-        """Start continuous rotation of the molecular view"""
+        """Start continuous rotation of the molecular view
+
+        Rotation is driven by requestAnimationFrame, so it follows the display
+        refresh rate and pauses while the tab is hidden. ``speed`` keeps its
+        meaning of degrees per 50ms.
+        """
         js_code = f"""
         var viewer = $3Dmol.viewers['{self.id}'];
         
+        // Initialize rotation state objects
+        window.py3dmol_raf = window.py3dmol_raf || {{}};
+        window.py3dmol_last_ts = window.py3dmol_last_ts || {{}};
+        
         // Stop any existing rotation
-        if (window.py3dmol_rotation_interval && window.py3dmol_rotation_interval['{self.id}']) {{
-            clearInterval(window.py3dmol_rotation_interval['{self.id}']);
+        if (window.py3dmol_raf['{self.id}']) {{
+            cancelAnimationFrame(window.py3dmol_raf['{self.id}']);
         }}
+        window.py3dmol_last_ts['{self.id}'] = 0;
         
-        // Initialize rotation intervals object
-        window.py3dmol_rotation_interval = window.py3dmol_rotation_interval || {{}};
-        
-        // Start new rotation
-        window.py3dmol_rotation_interval['{self.id}'] = setInterval(function() {{
-            viewer.rotate({speed}, '{axis}');
+        // Start new rotation, scaled by the time since the previous frame
+        function tick(ts) {{
+            if (!window.py3dmol_last_ts['{self.id}']) window.py3dmol_last_ts['{self.id}'] = ts;
+            var dt = ts - window.py3dmol_last_ts['{self.id}'];
+            window.py3dmol_last_ts['{self.id}'] = ts;
+            viewer.rotate({speed} * dt / 50, '{axis}');
             viewer.render();
-        }}, 50); // Rotate every 50ms
+            window.py3dmol_raf['{self.id}'] = requestAnimationFrame(tick);
+        }}
+        window.py3dmol_raf['{self.id}'] = requestAnimationFrame(tick);
         
         console.log('🔄 Started rotation on {axis} axis with speed {speed}');
         """
@@ -1073,15 +1246,14 @@ class JS3DMol(object):
     def stop_rotation(self):
         """Stop the continuous rotation"""
         js_code = f"""
-        if (window.py3dmol_rotation_interval && window.py3dmol_rotation_interval['{self.id}']) {{
-            clearInterval(window.py3dmol_rotation_interval['{self.id}']);
-            window.py3dmol_rotation_interval['{self.id}'] = null;
+        if (window.py3dmol_raf && window.py3dmol_raf['{self.id}']) {{
+            cancelAnimationFrame(window.py3dmol_raf['{self.id}']);
+            window.py3dmol_raf['{self.id}'] = null;
             console.log('⏹️ Stopped rotation');
         }}
         """
         self.executeCode(js_code)
 
-
 # Create EmptyViewer as an alias for JS3DMol for backward compatibility
 class EmptyViewer(JS3DMol):
     """
@@ -1092,33 +1264,33 @@ class EmptyViewer(JS3DMol):
 
 # Module-level utility functions
 def get_headless_status():
-    """Get global headless status information"""
-    global _HEADLESS_AVAILABLE, _HEADLESS_CAPTURE, _HEADLESS_ERROR
+    """Get global headless status information (captures run on the driver pool)"""
+    pool = _driver_pool.status() if _driver_pool is not None else {}
     return {
         'available': _HEADLESS_AVAILABLE,
-        'initialized': _HEADLESS_CAPTURE is not None,
+        'initialized': pool.get('drivers', 0) > 0,
         'error': _HEADLESS_ERROR,
-        'driver_ready': _HEADLESS_CAPTURE is not None and _HEADLESS_CAPTURE.is_available() if _HEADLESS_CAPTURE else False
+        'driver_ready': pool.get('driver_type') is not None,
+        'driver_type': pool.get('driver_type'),
+        'pool': pool
     }
 
 def cleanup_headless():
     """Cleanup global headless resources"""
-    global _HEADLESS_CAPTURE
-    if _HEADLESS_CAPTURE:
-        try:
-            _HEADLESS_CAPTURE.close()
-            print("✅ Global headless driver cleaned up")
-        except:
-            pass
-        _HEADLESS_CAPTURE = None
+    if _driver_pool is not None and _driver_pool.status()['drivers'] > 0:
+        _driver_pool.close()
+        print("✅ Headless drivers cleaned up")
+
+# Quit the lazily started webdrivers when the interpreter exits
+atexit.register(cleanup_headless)
 
 def reinitialize_headless():
     """Reinitialize headless capture (useful if it failed during import)"""
-    global _HEADLESS_AVAILABLE, _HEADLESS_CAPTURE, _HEADLESS_ERROR
+    global _HEADLESS_AVAILABLE, _HEADLESS_ERROR, _driver_pool
     
     print("🔄 Reinitializing headless capture...")
     
-    # Clean up existing instance
+    # Quit the existing drivers
     cleanup_headless()
     
     # Reset state
@@ -1126,18 +1298,19 @@ def reinitialize_headless():
     _HEADLESS_ERROR = None
     
     try:
-        from .headless_capture import HeadlessCapture
+        from .headless_capture import _driver_pool
         
-        print("📊 Creating new headless capture instance...")
-        _HEADLESS_CAPTURE = HeadlessCapture()
-        _HEADLESS_AVAILABLE = _HEADLESS_CAPTURE.is_available()
+        # Start the first pooled driver now; it stays in the pool for the next capture
+        print("📊 Starting a pooled headless driver...")
+        with _driver_pool.acquire() as capture:
+            _HEADLESS_AVAILABLE = capture is not None
         
         if _HEADLESS_AVAILABLE:
             print("✅ Headless capture reinitialized successfully!")
             return True
         else:
+            _HEADLESS_ERROR = "No webdriver available (install Chrome/Firefox)"
             print("⚠️ Headless capture reinitialized but no webdriver available")
-            _HEADLESS_CAPTURE = None
             return False
             
     except Exception as e:
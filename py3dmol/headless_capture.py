@@ -8,19 +8,328 @@ when running outside of Jupyter notebooks (e.g., in scripts, servers, etc.).
 Uses Selenium WebDriver with headless browser to render and capture images.
 """
 
+import atexit
+import collections
+import contextlib
+import functools
+import json
 import os
+import re
+import threading
 import time
-import tempfile
 import base64
-from typing import Optional, Tuple
+import string
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 import logging
 
 # Set up logging
+_logger = logging.getLogger("py3dmol")
 logging.getLogger('selenium').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
-# Global driver cache for faster subsequent captures
+# Global driver cache for faster subsequent captures (quit at exit, see _cleanup_drivers)
 _global_driver_cache = None
+# Cleared when a capture hits a driver failure, so the next setup starts a new driver
+_global_driver_alive = False
+_global_driver_lock = threading.Lock()
+
+
+def _is_driver_failure(error) -> bool:
+    """Whether an exception from a WebDriver call means the browser/driver is gone"""
+    from selenium.common.exceptions import JavascriptException, TimeoutException, WebDriverException
+    from urllib3.exceptions import HTTPError
+    if isinstance(error, (JavascriptException, TimeoutException)):
+        return False
+    return isinstance(error, (WebDriverException, HTTPError, ConnectionError))
+
+# chromedriver binary, resolved once per process ('' = use the system chromedriver).
+# Set PY3DMOL_CHROMEDRIVER to skip webdriver_manager entirely (e.g. in CI).
+_CHROMEDRIVER_PATH = None
+_CHROMEDRIVER_LOCK = threading.Lock()
+
+
+def _chromedriver_path() -> Optional[str]:
+    """Resolve the chromedriver path on first use; None means the system chromedriver"""
+    global _CHROMEDRIVER_PATH
+    with _CHROMEDRIVER_LOCK:
+        if _CHROMEDRIVER_PATH is None:
+            path = os.environ.get('PY3DMOL_CHROMEDRIVER', '')
+            if not path:
+                try:
+                    from webdriver_manager.chrome import ChromeDriverManager
+                    path = ChromeDriverManager().install()
+                except ImportError:
+                    pass
+            _CHROMEDRIVER_PATH = path
+        return _CHROMEDRIVER_PATH or None
+
+# WebGL backend for headless Chrome, from PY3DMOL_GL:
+#   auto (default)  GPU through ANGLE when available, SwiftShader otherwise
+#   vulkan          ANGLE on Vulkan
+#   swiftshader     always software rendering (CI/Docker without a GPU)
+_GL_ARGUMENTS = {
+    'auto': (),
+    'vulkan': ('--use-angle=vulkan', '--enable-features=Vulkan'),
+    'swiftshader': ('--use-gl=swiftshader',),
+}
+
+
+def _gl_arguments() -> Tuple[str, ...]:
+    """Chrome flags selecting the WebGL backend named by PY3DMOL_GL"""
+    gl = os.environ.get('PY3DMOL_GL', 'auto').strip().lower()
+    if gl not in _GL_ARGUMENTS:
+        print(f"⚠️ Unknown PY3DMOL_GL={gl!r}, using 'auto'")
+        gl = 'auto'
+    return _GL_ARGUMENTS[gl]
+
+# Commands that declare names or return can't be moved into a function body without
+# changing what later commands see, so they are never deduplicated (conservative: any
+# occurrence of these keywords, even in a nested function or a string, keeps it inline)
+_SCOPED_JS_RE = re.compile(r'\b(?:var|let|const|function|class|return)\b')
+
+# Shorter commands (e.g. a render call) are cheaper inline than as a function plus calls
+_HOIST_MIN_LEN = 64
+
+# Quality (0-100) for lossy capture formats (webp, the default, and jpeg)
+_LOSSY_QUALITY = 85
+
+# CDN copy of 3Dmol.js, used by the capture page when the bundled one is missing
+_CDN_3DMOL_JS = "https://3Dmol.csb.pitt.edu/build/3Dmol-min.js"
+
+
+@functools.lru_cache(maxsize=None)
+def _load_3dmol_js() -> str:
+    """Read the bundled 3Dmol.js on first use ('' if it is missing)"""
+    try:
+        from importlib.resources import files
+        return (files(__package__) / "3Dmol-min.js").read_text(encoding="utf-8")
+    except (ImportError, FileNotFoundError, AttributeError, TypeError):
+        # Fallback for Python < 3.9, development, or if package resource is not available
+        module_dir = os.path.dirname(__file__)
+        # Try both the minified and non-minified versions
+        for js_filename in ["3Dmol-min.js", "3dmol.js"]:
+            js_path = os.path.join(module_dir, js_filename)
+            if os.path.exists(js_path):
+                with open(js_path, 'r', encoding='utf-8') as f:
+                    js = f.read()
+                print(f"✅ Loaded local 3DMol.js from: {js_path}")
+                return js
+        print("⚠️  No local 3DMol.js file found")
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _3dmol_script_tag() -> str:
+    """<script> element for 3Dmol.js: the bundled copy inlined, or the CDN as a fallback"""
+    js = _load_3dmol_js()
+    if not js:
+        return f'<script src="{_CDN_3DMOL_JS}"></script>'
+    # The source is embedded verbatim, so it must not close its own script element
+    return "<script>" + js.replace("</script", "<\\/script") + "</script>"
+
+
+# Render helpers defined by both the notebook viewer page and the capture page
+# (substituted into _VIEWER_TEMPLATE and _HEADLESS_TEMPLATE)
+_RENDER_HELPERS_JS = """\
+// Coalesce renders requested by commands into one per animation frame
+window.py3dmol_pending = window.py3dmol_pending || {};
+window.py3dmol_schedule_render = window.py3dmol_schedule_render || function(id) {
+    if (window.py3dmol_pending[id]) return;
+    window.py3dmol_pending[id] = requestAnimationFrame(function() {
+        window.py3dmol_pending[id] = 0;
+        $3Dmol.viewers[id].render();
+    });
+};
+// Render immediately, dropping any render scheduled for the next frame
+window.py3dmol_flush_render = window.py3dmol_flush_render || function(id) {
+    if (window.py3dmol_pending[id]) {
+        cancelAnimationFrame(window.py3dmol_pending[id]);
+        window.py3dmol_pending[id] = 0;
+    }
+    $3Dmol.viewers[id].render();
+};"""
+
+# Capture page, compiled once at import. It is loaded once per driver tab and every
+# capture then runs _HEADLESS_RUN_TEMPLATE in it. Placeholders are ${lib} (the 3Dmol.js
+# script element), ${render_helpers} and ${run};
+# literal dollars are doubled.
+_HEADLESS_TEMPLATE = string.Template("""
+<!DOCTYPE html>
+<html>
+<head>
+    ${lib}
+    <style>
+        body { margin: 0; padding: 0; background: white; }
+    </style>
+</head>
+<body>
+    <div id="viewer"></div>
+    <script>
+        ${render_helpers}
+        // Release a viewer's WebGL context instead of waiting for GC
+        window.py3dmol_release = function(viewer) {
+            try {
+                var canvas = viewer.getCanvas();
+                var gl = canvas.getContext('webgl') || canvas.getContext('experimental-webgl');
+                var lose = gl && gl.getExtension('WEBGL_lose_context');
+                if (lose) lose.loseContext();
+            } catch (e) {}
+        };
+        // Stop animations and renders left over from the previous capture and free its viewer
+        window.py3dmol_reset = function() {
+            [window.py3dmol_raf || {}, window.py3dmol_pending].forEach(function(frames) {
+                Object.keys(frames).forEach(function(id) { cancelAnimationFrame(frames[id]); });
+            });
+            window.py3dmol_raf = {};
+            window.py3dmol_pending = {};
+            if (window.viewer) window.py3dmol_release(window.viewer);
+            window.viewer = null;
+            $$3Dmol.viewers = {};
+            document.getElementById('viewer').innerHTML = '';
+        };
+        // Create a viewer in element and run its commands; run() gets the viewer as __V__
+        window.py3dmol_build_viewer = function(element, id, run) {
+            var viewer = $$3Dmol.createViewer(element, {
+                defaultcolors: $$3Dmol.elementColors.Jmol,
+                backgroundColor: 0xffffff
+            });
+            
+            // Create viewers object for compatibility with commands
+            $$3Dmol.viewers[id] = viewer;
+            console.log('✅ Created viewer with ID: ' + id);
+            
+            try {
+                console.log('🎬 Executing viewer commands...');
+                run(viewer);
+                
+                // Ensure final render
+                console.log('🎨 Final render...');
+                window.py3dmol_flush_render(id);
+                
+                console.log('✅ All commands executed successfully');
+                
+            } catch (error) {
+                console.error('❌ Error executing viewer commands:', error);
+                
+                // Fallback: create a simple empty viewer
+                console.log('🔄 Creating fallback empty viewer');
+                viewer.render();
+            }
+            return viewer;
+        };
+    </script>
+    ${run}
+</body>
+</html>
+""")
+
+# Per-capture script run in the capture page (as the body of a function). Returns 'ready'
+# when the frame is painted, 'pending' if not yet, or false when the page isn't loaded.
+# Placeholders are ${width}, ${height}, ${viewer_id} and ${commands}.
+_HEADLESS_RUN_TEMPLATE = string.Template("""
+        if (typeof $$3Dmol === 'undefined' || !window.py3dmol_build_viewer) return false;
+        console.log('🔧 Initializing headless 3DMol viewer');
+        window.viewerReady = false;
+        window.py3dmol_reset();
+        
+        var element = document.getElementById('viewer');
+        element.style.width = '${width}px';
+        element.style.height = '${height}px';
+        
+        // Initialize 3DMol viewer and store it globally for access
+        window.viewer = window.py3dmol_build_viewer(element, '${viewer_id}', function(__V__) {
+            ${commands}
+        });
+        
+        // Mark as ready only once the final render produced a non-empty canvas
+        var canvas = window.viewer.getCanvas();
+        window.viewerReady = !!(canvas && canvas.width > 0);
+        console.log(window.viewerReady ? '✅ Headless viewer ready' : '⏳ Canvas not sized yet');
+        return window.viewerReady ? 'ready' : 'pending';
+""")
+
+# Script capturing several viewers in one call; returns a data URL (or null) per viewer,
+# or false when the page isn't loaded. Placeholders are ${width}, ${height}, ${format},
+# ${quality}, ${count} and ${captures} (one capture(id, function(__V__) {...}) call per viewer).
+_HEADLESS_BATCH_TEMPLATE = string.Template("""
+        if (typeof $$3Dmol === 'undefined' || !window.py3dmol_build_viewer) return false;
+        console.log('🔧 Capturing ${count} headless 3DMol viewers');
+        window.viewerReady = false;
+        window.py3dmol_reset();
+        
+        var container = document.getElementById('viewer');
+        container.style.width = '${width}px';
+        container.style.height = 'auto';
+        
+        // Build, render and read back one viewer at a time, releasing each WebGL context
+        // before the next so large batches stay under the browser's context limit
+        var images = [];
+        function capture(id, run) {
+            var element = document.createElement('div');
+            element.style.width = '${width}px';
+            element.style.height = '${height}px';
+            element.style.position = 'relative';
+            container.appendChild(element);
+            
+            var viewer = window.py3dmol_build_viewer(element, id, run);
+            try {
+                viewer.render();
+                images.push(viewer.getCanvas().toDataURL('image/${format}', ${quality}));
+            } catch (error) {
+                console.error('❌ Canvas capture failed:', error);
+                images.push(null);
+            }
+            window.py3dmol_release(viewer);
+            container.removeChild(element);
+        }
+        
+        ${captures}
+        
+        window.py3dmol_reset();
+        return images;
+""")
+
+# Readiness poll used when the canvas wasn't sized when the capture script ran: render
+# again once it is, then report ready
+_READY_CHECK_JS = """
+    if (!window.viewerReady && window.viewer) {
+        var canvas = window.viewer.getCanvas();
+        if (canvas && canvas.width > 0) {
+            window.viewer.render();
+            window.viewerReady = true;
+        }
+    }
+    return window.viewerReady === true;
+"""
+
+@functools.lru_cache(maxsize=None)
+def _capture_page_parts() -> Tuple[str, str]:
+    """Capture page head and tail around ${run}, with the 3Dmol.js script substituted once"""
+    # Pages are then assembled with a join instead of re-substituting the ~300 KB library
+    marker = '\x00py3dmol-run\x00'
+    page = _HEADLESS_TEMPLATE.substitute(lib=_3dmol_script_tag(),
+                                         render_helpers=_RENDER_HELPERS_JS, run=marker)
+    head, _, tail = page.partition(marker)
+    return head, tail
+
+
+# data: URL of the capture page, built once per process. With 3Dmol.js inlined it is
+# fully self-contained, so nothing is written to disk or fetched over the network.
+_capture_page_data_url = None
+_capture_page_lock = threading.Lock()
+
+
+def _capture_page_url() -> str:
+    """Build the (viewer-independent) capture page once and return its data: URL"""
+    global _capture_page_data_url
+    with _capture_page_lock:
+        if _capture_page_data_url is None:
+            html = ''.join(_capture_page_parts())
+            _capture_page_data_url = ("data:text/html;base64,"
+                                      + base64.b64encode(html.encode('utf-8')).decode('ascii'))
+        return _capture_page_data_url
+
 
 class HeadlessCapture:
     """Headless image capture using Selenium WebDriver"""
@@ -28,24 +337,43 @@ class HeadlessCapture:
     def __init__(self, reuse_driver=True):
         self.driver = None
         self.reuse_driver = reuse_driver
+        # PY3DMOL_DEBUG=1 restores the browser console dump on capture timeouts
+        self.debug = bool(os.environ.get('PY3DMOL_DEBUG'))
         self._setup_driver()
     
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Quit a private driver; a shared one is only released (quit at exit)"""
+        if self.reuse_driver and self.driver is _global_driver_cache:
+            self.driver = None
+        else:
+            self.close()
+        return False
+    
     def _setup_driver(self):
-        """Setup headless Chrome/Firefox driver"""
-        global _global_driver_cache
+        """Setup headless Chrome/Firefox driver, reusing the shared one if allowed"""
+        global _global_driver_cache, _global_driver_alive
         
-        # Try to reuse existing driver if available
-        if self.reuse_driver and _global_driver_cache is not None:
-            try:
-                # Test if driver is still working
-                _global_driver_cache.current_url
+        if not self.reuse_driver:
+            self._start_driver()
+            return
+        
+        # One thread starts the shared driver; the others wait and reuse it
+        with _global_driver_lock:
+            # Reuse the existing driver unless a capture found it dead (no WebDriver probe)
+            if _global_driver_cache is not None and _global_driver_alive:
                 self.driver = _global_driver_cache
                 print("✅ Reusing existing headless driver (faster!)")
                 return
-            except:
-                # Driver is dead, create new one
-                _global_driver_cache = None
-        
+            
+            self._start_driver()
+            _global_driver_cache = self.driver
+            _global_driver_alive = self.driver is not None
+    
+    def _start_driver(self):
+        """Start a new headless Chrome/Firefox driver"""
         try:
             from selenium import webdriver
             from selenium.webdriver.chrome.options import Options as ChromeOptions
@@ -54,36 +382,47 @@ class HeadlessCapture:
             # Try Chrome first
             try:
                 options = ChromeOptions()
-                options.add_argument('--headless')
+                options.add_argument('--headless=new')
                 options.add_argument('--no-sandbox')
                 options.add_argument('--disable-dev-shm-usage')
                 options.add_argument('--window-size=1920,1080')
                 options.add_argument('--disable-web-security')
                 options.add_argument('--allow-running-insecure-content')
                 
+                # Only collect errors in the browser log (read on capture timeouts)
+                options.set_capability('goog:loggingPrefs', {'browser': 'SEVERE'})
+                
+                # Skip services that only add cold-start I/O
+                options.add_argument('--disable-extensions')
+                options.add_argument('--disable-background-networking')
+                options.add_argument('--disable-sync')
+                options.add_argument('--disable-default-apps')
+                options.add_argument('--no-first-run')
+                options.add_argument('--disable-translate')
+                options.add_argument('--mute-audio')
+                options.add_argument('--metrics-recording-only')
+                
                 # WebGL support flags (don't disable GPU for WebGL)
                 options.add_argument('--enable-webgl')
-                options.add_argument('--use-gl=swiftshader')  # Software rendering for WebGL
                 options.add_argument('--enable-accelerated-2d-canvas')
                 options.add_argument('--disable-gpu-sandbox')
                 options.add_argument('--ignore-gpu-blacklist')
+                # Software WebGL stays available as Chrome's fallback when there is no GPU
                 options.add_argument('--enable-unsafe-swiftshader')
-                options.add_argument('--disable-features=VizDisplayCompositor')
+                for arg in _gl_arguments():
+                    options.add_argument(arg)
                 
-                # Try to find Chrome driver automatically
-                try:
-                    from webdriver_manager.chrome import ChromeDriverManager
-                    service = ChromeService(ChromeDriverManager().install())
+                # Find the Chrome driver (resolved once per process)
+                driver_path = _chromedriver_path()
+                if driver_path:
+                    service = ChromeService(driver_path)
                     self.driver = webdriver.Chrome(service=service, options=options)
-                    _global_driver_cache = self.driver
                     print("✅ Headless Chrome driver initialized")
-                    return
-                except ImportError:
+                else:
                     # Try system chromedriver
                     self.driver = webdriver.Chrome(options=options)
-                    _global_driver_cache = self.driver
                     print("✅ Headless Chrome driver initialized (system)")
-                    return
+                return
                     
             except Exception as e:
                 print(f"❌ Chrome driver failed: {e}")
@@ -102,12 +441,10 @@ class HeadlessCapture:
                     from webdriver_manager.firefox import GeckoDriverManager
                     service = FirefoxService(GeckoDriverManager().install())
                     self.driver = webdriver.Firefox(service=service, options=options)
-                    _global_driver_cache = self.driver
                     print("✅ Headless Firefox driver initialized")
                     return
                 except ImportError:
                     self.driver = webdriver.Firefox(options=options)
-                    _global_driver_cache = self.driver
                     print("✅ Headless Firefox driver initialized (system)")
                     return
                     
@@ -124,7 +461,7 @@ class HeadlessCapture:
         return self.driver is not None
     
     def capture_viewer_image(self, viewer, width: int = 800, height: int = 600, 
-                           format: str = 'png') -> Optional[str]:
+                           format: str = 'webp') -> Optional[bytes]:
         """
         Capture image from py3dmol viewer in headless mode
         
@@ -132,70 +469,52 @@ class HeadlessCapture:
             viewer: py3dmol viewer object
             width: Image width
             height: Image height
-            format: Image format ('png' or 'jpeg')
+            format: Image format ('webp', 'png' or 'jpeg')
             
         Returns:
-            Base64 encoded image data or None if failed
+            Encoded image bytes or None if failed
         """
         if not self.is_available():
             print("❌ Headless capture not available")
             return None
             
         try:
-            # Create a temporary HTML file with the viewer
-            html_content = self._create_viewer_html(viewer, width, height)
+            from selenium.common.exceptions import TimeoutException
+            from selenium.webdriver.support.ui import WebDriverWait
             
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False) as f:
-                f.write(html_content)
-                html_file = f.name
+            # Build the viewer in the persistent capture tab; the page (and 3Dmol.js)
+            # is only loaded the first time, or after the tab navigated away
+            script = self._create_viewer_script(viewer, width, height)
+            status = self.driver.execute_script(script)
+            if not status:
+                self.driver.get(_capture_page_url())
+                status = self.driver.execute_script(script)
+            if not status:
+                # Still no 3Dmol in a freshly loaded page (e.g. the CDN fallback failed):
+                # there is no viewer, and a screenshot would only be a blank page
+                print("❌ 3Dmol.js not available in the capture page")
+                return None
             
+            # The capture script renders synchronously and reports whether the canvas
+            # was painted, so the wait (and its extra round-trips) is usually skipped
+            max_wait_time = 10  # Maximum 10 seconds
+            start_time = time.time()
+            ready = status == 'ready'
             try:
-                # Load the HTML file in headless browser
-                self.driver.get(f"file://{html_file}")
+                if not ready:
+                    WebDriverWait(self.driver, max_wait_time, poll_frequency=0.05).until(
+                        lambda d: d.execute_script(_READY_CHECK_JS)
+                    )
+                    ready = True
+                    elapsed = time.time() - start_time
+                    print(f"🔍 Viewer ready (took {elapsed:.2f}s)")
+            except TimeoutException:
+                # Timeout reached
+                print(f"⚠️ Viewer ready timeout after {max_wait_time}s - proceeding anyway")
                 
-                # Smart wait for 3DMol to load and render (with polling instead of fixed sleep)
-                max_wait_time = 8  # Maximum 8 seconds
-                poll_interval = 0.2  # Check every 200ms
-                start_time = time.time()
-                
-                # Fast polling for viewer readiness
-                while time.time() - start_time < max_wait_time:
-                    try:
-                        ready_result = self.driver.execute_script("""
-                            if (typeof $3Dmol === 'undefined') {
-                                return {status: 'loading', message: '$3Dmol loading...'};
-                            }
-                            
-                            if (!window.viewer) {
-                                return {status: 'loading', message: 'viewer loading...'};
-                            }
-                            
-                            // Force render and check if canvas is ready
-                            window.viewer.render();
-                            var canvas = window.viewer.getCanvas();
-                            
-                            if (!canvas || canvas.width === 0 || canvas.height === 0) {
-                                return {status: 'loading', message: 'canvas loading...'};
-                            }
-                            
-                            return {status: 'success', message: 'Viewer ready'};
-                        """)
-                        
-                        if ready_result and ready_result.get('status') == 'success':
-                            elapsed = time.time() - start_time
-                            print(f"🔍 Viewer readiness check: {ready_result} (took {elapsed:.1f}s)")
-                            break
-                            
-                    except Exception as e:
-                        # Continue polling if JavaScript not ready yet
-                        pass
-                    
-                    time.sleep(poll_interval)
-                else:
-                    # Timeout reached
-                    print(f"⚠️ Viewer ready timeout after {max_wait_time}s - proceeding anyway")
-                    
-                    # Check for JavaScript errors only on timeout
+                # Check for JavaScript errors only on timeout, and only when debugging:
+                # get_log is a WebDriver round-trip that drains the whole log buffer
+                if self.debug or _logger.isEnabledFor(logging.DEBUG):
                     try:
                         logs = self.driver.get_log('browser')
                         if logs:
@@ -205,139 +524,329 @@ class HeadlessCapture:
                                     print(f"   {log['level']}: {log['message']}")
                     except:
                         pass
-                
-                # Fast canvas capture with minimal logging
+            
+            # Page screenshots only once the viewer has painted; otherwise they would
+            # return the blank page. The canvas read below checks the canvas itself.
+            image_bytes = None
+            if ready:
+                # Chrome: grab the composited viewer straight from the browser over CDP,
+                # which encodes natively instead of through canvas.toDataURL in JS
+                image_bytes = self._capture_screenshot(width, height, format)
+            
+            if image_bytes is None and ready and format == 'png':
+                # Other browsers: the driver's element screenshot is PNG encoded by the
+                # browser itself, again avoiding JS-side encoding in the page
+                image_bytes = self._capture_element_png()
+            
+            if image_bytes is None:
+                # Fast canvas capture with minimal logging (browsers don't know image/jpg
+                # and would silently fall back to PNG)
+                mimetype = 'image/jpeg' if format in ('jpg', 'jpeg') else f'image/{format}'
                 canvas_data = self.driver.execute_script("""
                     if (!window.viewer) return null;
                     
                     try {
                         var canvas = window.viewer.getCanvas();
                         if (!canvas || canvas.width === 0 || canvas.height === 0) return null;
-                        return canvas.toDataURL('image/""" + format + """');
+                        return canvas.toDataURL(arguments[0], arguments[1]);
                     } catch (error) {
                         return null;
                     }
-                """)
-                
+                """, mimetype, _LOSSY_QUALITY / 100)
                 if canvas_data:
-                    print(f"✅ Headless capture successful")
-                    return canvas_data
-                else:
-                    print("❌ Canvas capture failed")
-                    return None
-                    
-            finally:
-                # Clean up temp file
-                try:
-                    os.unlink(html_file)
-                except:
-                    pass
+                    image_bytes = base64.b64decode(canvas_data.split(',', 1)[1])
+            
+            if image_bytes:
+                print(f"✅ Headless capture successful")
+                return image_bytes
+            else:
+                print("❌ Canvas capture failed")
+                return None
                     
         except Exception as e:
             print(f"❌ Headless capture error: {e}")
+            if _is_driver_failure(e):
+                # The browser or driver is gone: start a fresh one for the next capture
+                self._restart_driver()
             return None
     
-    def _create_viewer_html(self, viewer, width: int, height: int) -> str:
-        """Create standalone HTML file with 3DMol viewer"""
+    def _restart_driver(self):
+        """Replace a dead driver (marking the shared one dead so nobody reuses it)"""
+        global _global_driver_alive
+        with _global_driver_lock:
+            if self.driver is _global_driver_cache:
+                _global_driver_alive = False
+        try:
+            self.driver.quit()
+        except:
+            pass
+        self.driver = None
+        print("🔄 Restarting headless driver...")
+        self._setup_driver()
+    
+    def _capture_screenshot(self, width: int, height: int, format: str) -> Optional[bytes]:
+        """Capture the viewer area with Page.captureScreenshot (Chrome only), or None"""
+        if not hasattr(self.driver, 'execute_cdp_cmd'):
+            return None
+        cdp_format = 'jpeg' if format in ('jpg', 'jpeg') else format
+        if cdp_format not in ('png', 'jpeg', 'webp'):
+            return None
+        try:
+            params = {
+                'format': cdp_format,
+                'clip': {'x': 0, 'y': 0, 'width': width, 'height': height, 'scale': 1},
+                'captureBeyondViewport': True,
+                # Favour encode speed over size (ignored by Chrome versions without it)
+                'optimizeForSpeed': True,
+            }
+            if cdp_format != 'png':
+                params['quality'] = _LOSSY_QUALITY
+            result = self.driver.execute_cdp_cmd('Page.captureScreenshot', params)
+        except Exception as e:
+            print(f"⚠️ CDP screenshot failed, using canvas.toDataURL: {e}")
+            return None
+        return base64.b64decode(result['data'])
+    
+    def _capture_element_png(self) -> Optional[bytes]:
+        """Capture the viewer element with the driver's own screenshot, or None"""
+        try:
+            from selenium.webdriver.common.by import By
+            return self.driver.find_element(By.ID, 'viewer').screenshot_as_png
+        except Exception as e:
+            print(f"⚠️ Element screenshot failed, using canvas.toDataURL: {e}")
+            return None
+    
+    def capture_viewer_image_b64(self, viewer, width: int = 800, height: int = 600,
+                                 format: str = 'webp') -> Optional[str]:
+        """
+        Capture image from py3dmol viewer as a base64 data URL
         
-        # Fast command extraction - simplified logic
-        viewer_commands = []
+        Returns:
+            Base64 encoded image data or None if failed
+        """
+        image_bytes = self.capture_viewer_image(viewer, width, height, format)
+        if image_bytes is None:
+            return None
+        return f"data:image/{format};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+    
+    def capture_viewer_images(self, viewers, width: int = 800, height: int = 600,
+                              format: str = 'webp') -> List[Optional[bytes]]:
+        """
+        Capture several viewers in one page with a single WebDriver round-trip
         
-        if hasattr(viewer, 'commands') and viewer.commands:
-            print(f"🔍 Extracting {len(viewer.commands)} commands...")
+        Args:
+            viewers: py3dmol viewer objects
+            width: Image width
+            height: Image height
+            format: Image format ('webp', 'png' or 'jpeg')
             
-            for cmd in viewer.commands:
-                # Simple extraction - just use the command as-is since we're queueing them now
-                if cmd and cmd.strip():
-                    viewer_commands.append(cmd.strip())
-        
-        # If no commands found, create a basic empty viewer
-        if not viewer_commands:
-            viewer_commands = ["console.log('Empty viewer created');"]
-        
-        print(f"✅ Using {len(viewer_commands)} commands")
-        
-        # Join all commands
-        commands_js = '\n        '.join(viewer_commands)
-        
-        html = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <script src="https://3Dmol.csb.pitt.edu/build/3Dmol-min.js"></script>
-    <style>
-        body {{ margin: 0; padding: 0; background: white; }}
-        #viewer {{ width: {width}px; height: {height}px; }}
-    </style>
-</head>
-<body>
-    <div id="viewer"></div>
-    <script>
-        console.log('🔧 Initializing headless 3DMol viewer');
-        
-        // Initialize 3DMol viewer
-        var viewer = $3Dmol.createViewer("viewer", {{
-            defaultcolors: $3Dmol.elementColors.Jmol,
-            backgroundColor: 0xffffff
-        }});
-        
-        // Store viewer globally for access
-        window.viewer = viewer;
-        
-        // Create viewers object for compatibility with commands
-        if (typeof $3Dmol !== 'undefined') {{
-            $3Dmol.viewers = $3Dmol.viewers || {{}};
-            $3Dmol.viewers['{viewer.id}'] = viewer;
-            console.log('✅ Created viewer with ID: {viewer.id}');
-        }}
+        Returns:
+            Encoded image bytes (or None if failed) for each viewer, in order
+        """
+        viewers = list(viewers)
+        if not viewers:
+            return []
+        if not self.is_available():
+            print("❌ Headless capture not available")
+            return [None] * len(viewers)
         
-        try {{
-            console.log('🎬 Executing viewer commands...');
-            
-            // Execute the actual commands from the viewer
-            {commands_js}
+        try:
+            script = self._create_batch_script(viewers, width, height, format)
+            images = self.driver.execute_script(script)
+            if images is False:
+                self.driver.get(_capture_page_url())
+                images = self.driver.execute_script(script)
             
-            // Ensure final render
-            console.log('🎨 Final render...');
-            viewer.render();
+            print(f"✅ Headless batch capture: {sum(1 for i in images if i)}/{len(viewers)} images")
+            return [base64.b64decode(image.split(',', 1)[1]) if image else None for image in images]
             
-            console.log('✅ All commands executed successfully');
+        except Exception as e:
+            print(f"❌ Headless batch capture error: {e}")
+            if _is_driver_failure(e):
+                self._restart_driver()
+            return [None] * len(viewers)
+    
+    def _create_batch_script(self, viewers, width: int, height: int, format: str) -> str:
+        """Create the script that builds and reads back every viewer in the capture page"""
+        captures = '\n        '.join(
+            f"capture({json.dumps(str(viewer.id))}, function(__V__) {{\n"
+            f"            {self._commands_js(viewer)}\n"
+            f"        }});"
+            for viewer in viewers
+        )
+        return _HEADLESS_BATCH_TEMPLATE.substitute(
+            width=width, height=height, count=len(viewers), captures=captures,
+            quality=_LOSSY_QUALITY / 100,
+            format='jpeg' if format in ('jpg', 'jpeg') else format)
+    
+    def _create_viewer_script(self, viewer, width: int, height: int) -> str:
+        """Create the script that (re)builds the viewer inside the capture page"""
+        return _HEADLESS_RUN_TEMPLATE.substitute(width=width, height=height, viewer_id=viewer.id,
+                                                 commands=self._commands_js(viewer))
+    
+    def _commands_js(self, viewer) -> str:
+        """The viewer's queued commands as one block of Javascript"""
+        
+        # Commands are stripped and empty ones dropped when they are queued
+        # (JS3DMol.executeCode), so they can be joined as-is
+        viewer_commands = getattr(viewer, 'commands', None)
+        if viewer_commands:
+            print(f"✅ Using {len(viewer_commands)} commands")
             
-        }} catch (error) {{
-            console.error('❌ Error executing viewer commands:', error);
+            # The command history is append-only, so the compiled block stays valid
+            # until another command is queued; repeated captures reuse it as-is
+            cached = getattr(viewer, '_commands_js_cache', None)
+            if cached and cached[0] == len(viewer_commands) and cached[1] is viewer_commands[-1]:
+                return cached[2]
             
-            // Fallback: create a simple empty viewer
-            console.log('🔄 Creating fallback empty viewer');
-            viewer.render();
-        }}
-        
-        // Mark as ready
-        window.viewerReady = true;
-        console.log('✅ Headless viewer ready');
-    </script>
-</body>
-</html>
-        """
-        return html
+            # Emit each repeated command once as a function and call it where it recurs,
+            # which keeps trajectories / pose grids with identical style calls small.
+            # Commands with declarations (e.g. a user's `var sel = ...`) stay inline.
+            counts = collections.Counter(viewer_commands)
+            if len(counts) == len(viewer_commands):
+                # Nothing repeats: a single C-level join, no per-command Python work
+                commands_js = '\n            '.join(viewer_commands)
+            else:
+                repeated = {cmd: f"_py3d_c{i}"
+                            for i, cmd in enumerate(cmd for cmd, n in counts.items()
+                                                    if n > 1 and len(cmd) >= _HOIST_MIN_LEN
+                                                    and not _SCOPED_JS_RE.search(cmd))}
+                # The command gets its own line so a trailing // comment can't swallow `};`
+                lines = [f"var {name} = function() {{\n{cmd}\n}};" for cmd, name in repeated.items()]
+                lines.extend(f"{repeated[cmd]}();" if cmd in repeated else cmd
+                             for cmd in viewer_commands)
+                commands_js = '\n            '.join(lines)
+            viewer._commands_js_cache = (len(viewer_commands), viewer_commands[-1], commands_js)
+        else:
+            # If no commands found, create a basic empty viewer
+            commands_js = "console.log('Empty viewer created');"
+        return commands_js
+    
+    def _create_viewer_html(self, viewer, width: int, height: int) -> str:
+        """Create standalone HTML file with 3DMol viewer"""
+        script = self._create_viewer_script(viewer, width, height)
+        run = "<script>\n    (function() {" + script + "    })();\n    </script>"
+        head, tail = _capture_page_parts()
+        return ''.join((head, run, tail))
     
     def close(self):
         """Close the webdriver"""
+        global _global_driver_cache
         if self.driver:
+            with _global_driver_lock:
+                if self.driver is _global_driver_cache:
+                    _global_driver_cache = None
             try:
                 self.driver.quit()
                 print("✅ Headless driver closed")
             except:
                 pass
             self.driver = None
+
+
+class _DriverPool:
+    """Up to max_size warm headless captures, each with its own driver, started lazily"""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._idle = []
+        self._in_use = set()  # checked-out captures, so close() can quit them too
+        # Guards _idle/_in_use/_created; waiters are woken whenever a capture or a slot frees up
+        self._cond = threading.Condition()
+        self._created = 0
+    
+    @contextlib.contextmanager
+    def acquire(self):
+        """Check out a capture (None if no driver can be started) and return it afterwards"""
+        capture = self._checkout()
+        try:
+            yield capture
+        finally:
+            if capture is not None:
+                self.release(capture)
+    
+    def _checkout(self) -> Optional[HeadlessCapture]:
+        """Take an idle capture, starting a new driver while the pool is below size"""
+        with self._cond:
+            while not self._idle and self._created >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                capture = self._idle.pop()
+                self._in_use.add(capture)
+                return capture
+            self._created += 1
+        
+        # Start the driver outside the lock so other callers can check out meanwhile
+        capture = None
+        try:
+            capture = HeadlessCapture(reuse_driver=False)
+        finally:
+            if capture is None or not capture.is_available():
+                self._free_slot()
+                capture = None
+        if capture is not None:
+            with self._cond:
+                self._in_use.add(capture)
+        return capture
     
-    def __del__(self):
-        """Cleanup on destruction"""
-        self.close()
+    def release(self, capture: HeadlessCapture):
+        """Return a capture; the page stays loaded (each capture resets the viewer itself)"""
+        with self._cond:
+            self._in_use.discard(capture)
+        if not capture.is_available():
+            # Its driver died and could not be restarted: give the slot back instead
+            self._free_slot()
+            return
+        with self._cond:
+            self._idle.append(capture)
+            self._cond.notify()
+    
+    def _free_slot(self):
+        """Forget a capture that has no driver, waking a caller waiting for a slot"""
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+    
+    def status(self) -> dict:
+        """Number of started drivers (idle and checked out) and the browser they run"""
+        with self._cond:
+            captures = self._idle + list(self._in_use)
+            status = {'drivers': self._created, 'idle': len(self._idle),
+                      'in_use': len(self._in_use)}
+        live = [c.driver for c in captures if c.is_available()]
+        status['driver_type'] = getattr(live[0], 'name', 'unknown') if live else None
+        return status
+    
+    def close(self):
+        """Quit all drivers, idle and checked out (those free their slot on release)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            in_use = list(self._in_use)
+            self._created -= len(idle)
+            self._cond.notify_all()
+        for capture in idle + in_use:
+            capture.close()
+
+
+def _pool_size_from_env() -> int:
+    """Pool size from PY3DMOL_DRIVER_POOL_SIZE, defaulting to min(cpu_count, 4)"""
+    default = min(os.cpu_count() or 1, 4)
+    try:
+        return int(os.environ.get('PY3DMOL_DRIVER_POOL_SIZE', default))
+    except ValueError:
+        return default
 
 
 # Global instance
 _headless_capture = None
 
+# Pool of captures with their own drivers, for convenience and batch captures
+_POOL_SIZE = _pool_size_from_env()
+_driver_pool = _DriverPool(_POOL_SIZE)
+
+# Most viewers captured by one capture_viewer_images() call in a batch
+_BATCH_CHUNK_SIZE = 32
+
 def get_headless_capture() -> Optional[HeadlessCapture]:
     """Get global headless capture instance"""
     global _headless_capture
@@ -346,7 +855,7 @@ def get_headless_capture() -> Optional[HeadlessCapture]:
     return _headless_capture
 
 def capture_headless_image(viewer, width: int = 800, height: int = 600, 
-                          format: str = 'png') -> Optional[str]:
+                          format: str = 'webp') -> Optional[str]:
     """
     Convenience function to capture image in headless mode
     
@@ -354,17 +863,64 @@ def capture_headless_image(viewer, width: int = 800, height: int = 600,
         viewer: py3dmol viewer object
         width: Image width
         height: Image height
-        format: Image format ('png' or 'jpeg')
+        format: Image format ('webp', 'png' or 'jpeg')
         
     Returns:
         Base64 encoded image data or None if failed
     """
-    capture = get_headless_capture()
-    if capture and capture.is_available():
-        return capture.capture_viewer_image(viewer, width, height, format)
+    with _driver_pool.acquire() as capture:
+        if capture is not None:
+            return capture.capture_viewer_image_b64(viewer, width, height, format)
     return None
 
 def is_headless_available() -> bool:
-    """Check if headless capture is available"""
-    capture = get_headless_capture()
-    return capture is not None and capture.is_available() 
\ No newline at end of file
+    """Check if headless capture is available (the driver started stays in the pool)"""
+    with _driver_pool.acquire() as capture:
+        return capture is not None
+
+def capture_headless_images_batch(viewers, width: int = 800, height: int = 600,
+                                  format: str = 'webp') -> List[Optional[bytes]]:
+    """
+    Capture several viewers concurrently, one pooled headless driver per worker
+    
+    Args:
+        viewers: py3dmol viewer objects
+        width: Image width
+        height: Image height
+        format: Image format ('webp', 'png' or 'jpeg')
+        
+    Returns:
+        Encoded image bytes (or None if failed) for each viewer, in order
+    """
+    viewers = list(viewers)
+    if not viewers:
+        return []
+    
+    # Spread the viewers over the pool; each worker captures its share in one page
+    workers = min(_driver_pool.max_size, len(viewers))
+    size = min(-(-len(viewers) // workers), _BATCH_CHUNK_SIZE)
+    chunks = [viewers[i:i + size] for i in range(0, len(viewers), size)]
+    
+    def capture_chunk(chunk):
+        with _driver_pool.acquire() as capture:
+            if capture is None:
+                return [None] * len(chunk)
+            return capture.capture_viewer_images(chunk, width, height, format)
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="py3dmol-headless") as executor:
+        return [image for images in executor.map(capture_chunk, chunks) for image in images]
+
+def _cleanup_drivers():
+    """Quit the shared and pooled drivers (registered with atexit instead of __del__,
+    which may run after selenium's transport is torn down and leak Chrome processes)"""
+    global _global_driver_cache
+    with _global_driver_lock:
+        driver, _global_driver_cache = _global_driver_cache, None
+    if driver is not None:
+        try:
+            driver.quit()
+        except Exception:
+            pass
+    _driver_pool.close()
+
+atexit.register(_cleanup_drivers)
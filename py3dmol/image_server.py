@@ -1,44 +1,98 @@
 import asyncio
+import os
 import threading
 import time
-import base64
 import io
+import socket
 import uuid
-import requests
 from typing import Optional
 
+import cachetools
 import numpy as np
+import requests
 from PIL import Image
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
 
+try:
+    # SIMD (SSSE3/AVX2) base64, several times faster on multi-MB image payloads
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
+try:
+    # Brotli for clients that accept it (falls back to gzip for those that don't)
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+try:
+    # orjson serializes the large base64 payloads several times faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
 # Global server state
 _server_instance = None
 _server_thread = None
 _server_port = 8769
 
+class _FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed (fastapi's own
+    ORJSONResponse is deprecated in recent releases)"""
+    
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
 class ImageData(BaseModel):
     request_id: str
     image_data: str
-    format: str = "png"
+    format: str = "webp"
     width: int = 400
     height: int = 300
 
+# Keep-alive session for health checks, so start-up polling reuses one connection
+_HTTP = requests.Session()
+_HTTP.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
 def is_server_running(port: int = 8769) -> bool:
-    """Check if server is already running"""
+    """Check if server is already running (a TCP connect, no HTTP round-trip)"""
     try:
-        response = requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
-        return response.status_code == 200
-    except:
+        socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+        return True
+    except OSError:
         return False
 
+def get_server_health(port: int = 8769) -> Optional[dict]:
+    """Health payload of the py3dmol server on port, or None if it doesn't answer"""
+    try:
+        response = _HTTP.get(f"http://127.0.0.1:{port}/health", timeout=0.2)
+        if response.status_code == 200:
+            return response.json()
+    except (requests.RequestException, ValueError):
+        pass
+    return None
+
 class ImageServer:
     def __init__(self, port: int = 8769):
         self.port = port
-        self.app = FastAPI(title="Py3DMol Image Server")
-        self.pending_requests = {}
+        self.app = FastAPI(title="Py3DMol Image Server", default_response_class=_FastJSONResponse)
+        # Stored images expire on their own, so an idle or long-running server doesn't
+        # keep every capture alive; the lock guards against the server and caller threads
+        self.pending_requests = cachetools.TTLCache(
+            maxsize=int(os.environ.get('PY3DMOL_CACHE_MAX', 256)), ttl=300)
+        self._requests_lock = threading.RLock()
+        # PIL decodes lazily and is not thread-safe, so pixel access is serialized
+        self._decode_lock = threading.Lock()
+        # Events for clients long-polling on images that have not arrived yet
+        self._image_events = {}
         
         # Enable CORS for all origins
         self.app.add_middleware(
@@ -48,50 +102,59 @@ class ImageServer:
             allow_methods=["*"],
             allow_headers=["*"],
         )
+        # Compress JSON responses (base64 image data, numpy payloads)
+        if BrotliMiddleware is not None:
+            self.app.add_middleware(BrotliMiddleware, quality=4, minimum_size=1024)
+        else:
+            self.app.add_middleware(GZipMiddleware, minimum_size=1024)
         
         self._setup_routes()
         
     def _setup_routes(self):
         @self.app.post("/convert_image")
-        async def convert_image(image_data: ImageData):
-            """Convert base64 image data to PIL/numpy format and store for retrieval"""
+        async def convert_image(request: Request):
+            """Store an image for retrieval
+            
+            Accepts either raw image bytes (Content-Type image/*, request ID in the
+            X-Request-Id header) or a JSON ImageData body with a base64 data URL.
+            """
             try:
-                print(f"🔄 Processing image request: {image_data.request_id}")
-                print(f"📏 Dimensions: {image_data.width}x{image_data.height}")
-                print(f"🎨 Format: {image_data.format}")
-                
-                # Extract base64 data from data URL
-                if ',' in image_data.image_data:
-                    base64_data = image_data.image_data.split(',')[1]
+                content_type = request.headers.get('content-type', '')
+                if content_type.startswith('image/'):
+                    request_id = request.headers.get('x-request-id')
+                    if not request_id:
+                        raise ValueError("Missing X-Request-Id header")
+                    image_format = content_type.split('/', 1)[1].split(';')[0]
+                    image_bytes = await request.body()
+                    print(f"🔄 Processing image request: {request_id}")
+                    print(f"🎨 Format: {image_format}")
                 else:
-                    base64_data = image_data.image_data
-                
-                print(f"📊 Base64 data length: {len(base64_data)}")
+                    image_data = ImageData(**await request.json())
+                    request_id = image_data.request_id
+                    image_format = image_data.format
+                    print(f"🔄 Processing image request: {request_id}")
+                    print(f"📏 Dimensions: {image_data.width}x{image_data.height}")
+                    print(f"🎨 Format: {image_format}")
+                    
+                    # Extract base64 data from data URL
+                    if ',' in image_data.image_data:
+                        base64_data = image_data.image_data.split(',')[1]
+                    else:
+                        base64_data = image_data.image_data
+                    
+                    print(f"📊 Base64 data length: {len(base64_data)}")
+                    
+                    # Decode base64 to bytes (in a worker thread: multi-MB payloads
+                    # would otherwise block every other route on the event loop)
+                    image_bytes = await run_in_threadpool(_b64.b64decode, base64_data,
+                                                          validate=False)
                 
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(base64_data)
                 print(f"📦 Image bytes length: {len(image_bytes)}")
-                
-                # Convert to PIL Image
-                pil_image = Image.open(io.BytesIO(image_bytes))
-                print(f"✅ PIL Image created: {pil_image.size} {pil_image.mode}")
-                
-                # Store the PIL image for retrieval
-                self.pending_requests[image_data.request_id] = {
-                    'pil_image': pil_image,
-                    'numpy_array': np.array(pil_image),
-                    'timestamp': time.time(),
-                    'format': image_data.format,
-                    'width': image_data.width,
-                    'height': image_data.height
-                }
-                
-                print(f"💾 Stored image for request: {image_data.request_id}")
-                print(f"📋 Total pending requests: {len(self.pending_requests)}")
+                pil_image = self._store_image(request_id, image_bytes, image_format)
                 
                 return {
                     "status": "success", 
-                    "request_id": image_data.request_id,
+                    "request_id": request_id,
                     "image_size": pil_image.size,
                     "message": "Image processed and stored successfully"
                 }
@@ -101,79 +164,143 @@ class ImageServer:
                 raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
         
         @self.app.get("/get_image/{request_id}")
-        async def get_image(request_id: str, format: str = "pil"):
-            """Retrieve processed image data"""
+        async def get_image(request_id: str, format: str = "pil", wait_ms: int = 0):
+            """Retrieve processed image data, optionally waiting up to wait_ms for it to arrive"""
             print(f"🔍 Looking for request: {request_id}")
-            print(f"📋 Available requests: {list(self.pending_requests.keys())}")
+            print(f"📋 Available requests: {self._request_ids()}")
             
-            if request_id not in self.pending_requests:
+            data = self._lookup(request_id)
+            if data is None and wait_ms > 0:
+                event = self._image_events.setdefault(request_id, asyncio.Event())
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=wait_ms / 1000)
+                except asyncio.TimeoutError:
+                    raise HTTPException(status_code=408, detail="Timed out waiting for image")
+                finally:
+                    if self._image_events.get(request_id) is event:
+                        del self._image_events[request_id]
+                data = self._lookup(request_id)
+            
+            if data is None:
                 raise HTTPException(status_code=404, detail="Request ID not found")
             
-            data = self.pending_requests[request_id]
             print(f"✅ Found request data for: {request_id}")
             
-            if format == "pil":
-                # Return base64 encoded image data
-                img_buffer = io.BytesIO()
-                data['pil_image'].save(img_buffer, format='PNG')
-                img_bytes = img_buffer.getvalue()
-                img_base64 = base64.b64encode(img_bytes).decode()
+            if format == "raw":
+                # Return the image bytes exactly as the browser sent them
+                return Response(content=data['image_bytes'],
+                                media_type=f"image/{data['format']}")
+            elif format == "pil":
+                # Return the stored bytes base64 encoded as they are: they are already
+                # a valid PNG/WebP/JPEG, so decoding and re-encoding only costs time
+                img_base64 = (await run_in_threadpool(_b64.b64encode, data['image_bytes'])).decode()
                 
                 return {
                     "status": "success",
                     "format": "pil",
-                    "image_data": f"data:image/png;base64,{img_base64}",
-                    "size": data['pil_image'].size
+                    "image_data": f"data:image/{data['format']};base64,{img_base64}",
+                    "size": (data['width'], data['height'])
                 }
             elif format == "numpy":
-                return {
-                    "status": "success", 
-                    "format": "numpy",
-                    "data": data['numpy_array'].tolist(),
-                    "shape": data['numpy_array'].shape
-                }
+                # Raw pixel buffer (base64) plus shape/dtype; a nested JSON list would
+                # allocate one Python object per channel value
+                return await run_in_threadpool(self._numpy_payload, data)
             else:
-                raise HTTPException(status_code=400, detail="Format must be 'pil' or 'numpy'")
+                raise HTTPException(status_code=400, detail="Format must be 'raw', 'pil' or 'numpy'")
         
         @self.app.get("/health")
         async def health():
             return {
                 "status": "healthy", 
                 "port": self.port,
-                "pending_requests": list(self.pending_requests.keys())
+                "pending_requests": self._request_ids()
             }
         
         @self.app.delete("/cleanup/{request_id}")
         async def cleanup_request(request_id: str):
             """Clean up stored image data"""
-            if request_id in self.pending_requests:
-                del self.pending_requests[request_id]
+            with self._requests_lock:
+                data = self.pending_requests.pop(request_id, None)
+            if data is not None:
                 return {"status": "cleaned", "request_id": request_id}
             return {"status": "not_found", "request_id": request_id}
     
+    def _store_image(self, request_id: str, image_bytes: bytes, image_format: str):
+        """Decode and store an image, waking up any client waiting for it"""
+        # Image.open only parses the header; pixels are decoded on first access
+        # (numpy retrieval), never for clients that just want the bytes back
+        pil_image = Image.open(io.BytesIO(image_bytes))
+        print(f"✅ PIL Image created: {pil_image.size} {pil_image.mode}")
+        
+        # The bytes are served back verbatim, so label them with what they actually are
+        # rather than the format the client declared (ImageData defaults to webp)
+        if pil_image.format:
+            image_format = pil_image.format.lower()
+        
+        # Store the raw bytes and the lazy PIL image (numpy arrays are built on request)
+        with self._requests_lock:
+            self.pending_requests[request_id] = {
+                'pil_image': pil_image,
+                'image_bytes': image_bytes,
+                'timestamp': time.time(),
+                'format': image_format,
+                'width': pil_image.width,
+                'height': pil_image.height
+            }
+        
+        # Wake up any client long-polling for this image
+        event = self._image_events.pop(request_id, None)
+        if event is not None:
+            event.set()
+        
+        print(f"💾 Stored image for request: {request_id}")
+        print(f"📋 Total pending requests: {len(self._request_ids())}")
+        return pil_image
+    
+    def _lookup(self, request_id: str) -> Optional[dict]:
+        """Stored data for request_id, or None if it never arrived or has expired"""
+        with self._requests_lock:
+            return self.pending_requests.get(request_id)
+    
+    def _request_ids(self) -> list:
+        """IDs of the images currently stored (expired ones are evicted first)"""
+        with self._requests_lock:
+            self.pending_requests.expire()
+            return list(self.pending_requests.keys())
+    
+    def _pixels(self, data: dict, writable: bool = False) -> np.ndarray:
+        """Pixel array of a stored image, decoding it on first use"""
+        with self._decode_lock:
+            # PIL exports pixels through tobytes(), so both calls copy; np.asarray
+            # returns a read-only array over that copy, np.array a writable one
+            if writable:
+                return np.array(data['pil_image'])
+            return np.asarray(data['pil_image'])
+    
+    def _numpy_payload(self, data: dict) -> dict:
+        """get_image response for format=numpy (CPU-bound, run off the event loop)"""
+        numpy_array = self._pixels(data)
+        return {
+            "status": "success", 
+            "format": "numpy",
+            "data": _b64.b64encode(numpy_array.tobytes()).decode(),
+            "shape": numpy_array.shape,
+            "dtype": str(numpy_array.dtype)
+        }
+    
     def get_stored_image(self, request_id: str, format: str = "pil"):
         """Synchronous method to get stored image data"""
-        if request_id not in self.pending_requests:
+        data = self._lookup(request_id)
+        if data is None:
             return None
         
-        data = self.pending_requests[request_id]
-        
         if format == "pil":
             return data['pil_image']
         elif format == "numpy":
-            return data['numpy_array']
+            # Built on demand; writable, since callers own the returned array
+            return self._pixels(data, writable=True)
         else:
             return None
-    
-    def cleanup_old_requests(self, max_age: int = 300):
-        """Clean up requests older than max_age seconds"""
-        current_time = time.time()
-        expired_keys = [
-            key for key, value in self.pending_requests.items()
-            if current_time - value['timestamp'] > max_age
-        ]
-        for key in expired_keys:
-            del self.pending_requests[key]
 
 def start_server(port: int = 8769) -> ImageServer:
     """Start the FastAPI server in a separate thread"""
@@ -181,7 +308,10 @@ def start_server(port: int = 8769) -> ImageServer:
     
     # Check if server is already running on the port
     if is_server_running(port):
-        print(f"✅ Py3DMol HTTP server already running on port {port}")
+        if get_server_health(port) is None:
+            print(f"⚠️ Port {port} is in use but is not answering as a Py3DMol server")
+        else:
+            print(f"✅ Py3DMol HTTP server already running on port {port}")
         return _server_instance
     
     # If server is already running in this process, return the existing instance
@@ -200,8 +330,10 @@ def start_server(port: int = 8769) -> ImageServer:
     _server_thread = threading.Thread(target=run_server, daemon=True)
     _server_thread.start()
     
-    # Wait a bit for the server to start
-    time.sleep(1)
+    # Wait until the server answers (up to 5 s) rather than for a fixed delay
+    deadline = time.time() + 5
+    while time.time() < deadline and get_server_health(port) is None:
+        time.sleep(0.05)
     
     return _server_instance
 
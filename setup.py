@@ -12,6 +12,7 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/avirshup/py3dmol",
     packages=['py3dmol'],
+    package_data={'py3dmol': ['3Dmol-min.js', 'callbacks.js', 'body.html']},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -23,8 +24,11 @@ setup(
         'ipywidgets>=7.0.0',
         'fastapi>=0.104.0',
         'uvicorn>=0.24.0',
+        'cachetools>=5.0.0',
         'pillow>=10.0.0',
         'numpy>=1.24.0',
+        'pybase64>=1.3.0',
+        'orjson>=3.9.0',
         'python-multipart>=0.0.6',
         'requests>=2.31.0',
         'pydantic>=2.0.0',